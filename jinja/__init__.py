@@ -61,13 +61,13 @@ from jinja.environment import Environment
 from jinja.datastructure import Markup
 from jinja.plugin import jinja_plugin_factory as template_plugin_factory
 from jinja.loaders import FileSystemLoader, PackageLoader, DictLoader, \
-     ChoiceLoader, FunctionLoader, MemcachedFileSystemLoader
+     ChoiceLoader, FunctionLoader, MemcachedFileSystemLoader, BundleLoader
 from jinja.utils import from_string
 
 
 __all__ = ['Environment', 'Markup', 'FileSystemLoader', 'PackageLoader',
            'DictLoader', 'ChoiceLoader', 'FunctionLoader',
-           'MemcachedFileSystemLoader', 'from_string']
+           'MemcachedFileSystemLoader', 'BundleLoader', 'from_string']
 
 __version__ = '1.3'
 __author__ = 'Armin Ronacher'
@@ -6,6 +6,10 @@
  * Context baseclass. If this extension is not compiled the datastructure
  * module implements a class in python.
  *
+ * Additionally it provides a tokenizer for templates with the default
+ * delimiters. If it's not available the lexer uses the regular
+ * expression based tokenizer.
+ *
  * Note that if you change semantics here you have to edit the _native.py
  * to in order to support those changes for jinja setups without the
  * speedup module too.
@@ -471,7 +475,564 @@ static PyTypeObject BaseContextType = {
 	0				/* tp_new */
 };
 
+/**
+ * Native tokenizer for the default delimiters.
+ *
+ * This implements the `Lexer.tokeniter` rules for environments that use
+ * the default ``{% %}``, ``{{ }}`` and ``{# #}`` delimiters. The token
+ * stream must be exactly the same as the one of the python lexer, so if
+ * you change the lexing rules in lexer.py you have to change them here
+ * too (or disable the native tokenizer for the changed configuration).
+ */
+
+/* Set by init_tokenizer to interned token type names */
+static PyObject *tok_data, *tok_raw_begin, *tok_raw_end, *tok_comment_begin,
+		*tok_comment, *tok_comment_end, *tok_block_begin,
+		*tok_block_end, *tok_variable_begin, *tok_variable_end,
+		*tok_float, *tok_integer, *tok_name, *tok_string, *tok_regex,
+		*tok_operator;
+
+/* the lexer states */
+enum { STATE_ROOT, STATE_COMMENT, STATE_RAW, STATE_BLOCK, STATE_VARIABLE };
+
+/* whitespace as matched by "\s" in the delimiter rules */
+#define IS_TAG_SPACE(c) ((c) == ' ' || ((c) >= '\t' && (c) <= '\r'))
+#define IS_DIGIT(c) ((c) >= '0' && (c) <= '9')
+#define IS_NAME_START(c) (((c) >= 'a' && (c) <= 'z') || \
+			  ((c) >= 'A' && (c) <= 'Z') || (c) == '_')
+#define IS_NAME_CHAR(c) (IS_NAME_START(c) || IS_DIGIT(c))
+
+/**
+ * Internal struct that holds the state of one tokenizer run.
+ */
+struct Tokenizer {
+	Py_UNICODE *source;		/* the normalized template source */
+	Py_ssize_t length;		/* length of the source */
+	Py_ssize_t pos;			/* current position */
+	long lineno;			/* line number at the current position */
+	int trim_blocks;		/* remove the newline after blocks? */
+	PyObject *tokens;		/* list of (lineno, type, value) */
+	PyObject *error;		/* (lineno, message) or NULL */
+	char *balancing;		/* stack of expected closing braces */
+	Py_ssize_t balancing_size;	/* used size of the stack */
+	Py_ssize_t balancing_alloc;	/* allocated size of the stack */
+};
+
+/**
+ * Called by init_speedups in order to create the interned token
+ * type names.
+ */
+static int
+init_tokenizer(void)
+{
+#define INTERN(var, name) if (!(var = PyString_InternFromString(name))) \
+				return 0
+	INTERN(tok_data, "data");
+	INTERN(tok_raw_begin, "raw_begin");
+	INTERN(tok_raw_end, "raw_end");
+	INTERN(tok_comment_begin, "comment_begin");
+	INTERN(tok_comment, "comment");
+	INTERN(tok_comment_end, "comment_end");
+	INTERN(tok_block_begin, "block_begin");
+	INTERN(tok_block_end, "block_end");
+	INTERN(tok_variable_begin, "variable_begin");
+	INTERN(tok_variable_end, "variable_end");
+	INTERN(tok_float, "float");
+	INTERN(tok_integer, "integer");
+	INTERN(tok_name, "name");
+	INTERN(tok_string, "string");
+	INTERN(tok_regex, "regex");
+	INTERN(tok_operator, "operator");
+#undef INTERN
+	return 1;
+}
+
+/**
+ * Move the position to `end` and count the newlines of the skipped text.
+ */
+static void
+Tokenizer_advance(struct Tokenizer *t, Py_ssize_t end)
+{
+	Py_ssize_t i;
+	for (i = t->pos; i < end; i++)
+		if (t->source[i] == '\n')
+			t->lineno++;
+	t->pos = end;
+}
+
+/**
+ * Add a token for the text up to `end` and move the position there.
+ * Empty tokens are skipped like in the python lexer.
+ */
+static int
+Tokenizer_emit(struct Tokenizer *t, PyObject *type, Py_ssize_t end)
+{
+	PyObject *token;
+	int rv;
+
+	if (end > t->pos) {
+		token = Py_BuildValue("(lOu#)", t->lineno, type,
+				      t->source + t->pos, (int)(end - t->pos));
+		if (!token)
+			return 0;
+		rv = PyList_Append(t->tokens, token);
+		Py_DECREF(token);
+		if (rv < 0)
+			return 0;
+	}
+	Tokenizer_advance(t, end);
+	return 1;
+}
+
+/**
+ * Remember a syntax error at the current line. The tokens up to the
+ * error are returned together with it so that the python side can yield
+ * them before raising the error.
+ */
+static int
+Tokenizer_fail(struct Tokenizer *t, PyObject *message)
+{
+	if (!message)
+		return 0;
+	t->error = Py_BuildValue("(lN)", t->lineno, message);
+	return 0;
+}
+
+/**
+ * Skip the "\s*" of a delimiter rule.
+ */
+static Py_ssize_t
+skip_tag_space(struct Tokenizer *t, Py_ssize_t pos)
+{
+	while (pos < t->length && IS_TAG_SPACE(t->source[pos]))
+		pos++;
+	return pos;
+}
+
+/**
+ * Match an ASCII string at the given position.
+ */
+static int
+match_string(struct Tokenizer *t, Py_ssize_t pos, const char *s)
+{
+	for (; *s; s++, pos++)
+		if (pos >= t->length || t->source[pos] != (Py_UNICODE)*s)
+			return 0;
+	return 1;
+}
+
+/**
+ * Match the "\s*raw\s*%}" part of a raw begin tag and return the end
+ * position or -1.
+ */
+static Py_ssize_t
+match_raw_tail(struct Tokenizer *t, Py_ssize_t pos)
+{
+	pos = skip_tag_space(t, pos);
+	if (!match_string(t, pos, "raw"))
+		return -1;
+	pos = skip_tag_space(t, pos + 3);
+	if (!match_string(t, pos, "%}"))
+		return -1;
+	return pos + 2;
+}
+
+/**
+ * Match the "\s*endraw\s*(?:-%}\s*|%}\n?)" part of a raw end tag and
+ * return the end position or -1.
+ */
+static Py_ssize_t
+match_endraw_tail(struct Tokenizer *t, Py_ssize_t pos)
+{
+	pos = skip_tag_space(t, pos);
+	if (!match_string(t, pos, "endraw"))
+		return -1;
+	pos = skip_tag_space(t, pos + 6);
+	if (match_string(t, pos, "-%}"))
+		return skip_tag_space(t, pos + 3);
+	if (!match_string(t, pos, "%}"))
+		return -1;
+	pos += 2;
+	if (t->trim_blocks && pos < t->length && t->source[pos] == '\n')
+		pos++;
+	return pos;
+}
+
+/**
+ * Tokenize template data up to the next tag.
+ */
+static int
+Tokenizer_root(struct Tokenizer *t, int *state)
+{
+	Py_UNICODE *s = t->source;
+	Py_ssize_t i, j, end = -1;
+	PyObject *type = NULL;
+
+	for (i = t->pos; i < t->length; i++) {
+		/* whitespace is only part of a tag if it's followed by a
+		   delimiter with a minus sign. */
+		if (IS_TAG_SPACE(s[i])) {
+			j = skip_tag_space(t, i);
+			if (j + 2 < t->length && s[j] == '{' && s[j + 2] == '-') {
+				if (s[j + 1] == '%') {
+					end = match_raw_tail(t, j + 3);
+					if (end >= 0)
+						type = tok_raw_begin;
+					else {
+						type = tok_block_begin;
+						end = j + 3;
+					}
+				}
+				else if (s[j + 1] == '#') {
+					type = tok_comment_begin;
+					end = j + 3;
+				}
+				else if (s[j + 1] == '{') {
+					type = tok_variable_begin;
+					end = j + 3;
+				}
+				if (type)
+					break;
+			}
+			i = j - 1;
+			continue;
+		}
+		if (s[i] != '{' || i + 1 >= t->length)
+			continue;
+		j = i + 2;
+		if (j < t->length && s[j] == '-')
+			j++;
+		if (s[i + 1] == '%') {
+			end = match_raw_tail(t, j);
+			if (end >= 0)
+				type = tok_raw_begin;
+			else {
+				type = tok_block_begin;
+				end = j;
+			}
+		}
+		else if (s[i + 1] == '#') {
+			type = tok_comment_begin;
+			end = j;
+		}
+		else if (s[i + 1] == '{') {
+			type = tok_variable_begin;
+			end = j;
+		}
+		if (type)
+			break;
+	}
+
+	/* no tag left, the rest of the template is data */
+	if (!type)
+		return Tokenizer_emit(t, tok_data, t->length);
+
+	if (!Tokenizer_emit(t, tok_data, i) || !Tokenizer_emit(t, type, end))
+		return 0;
+	if (type == tok_raw_begin)
+		*state = STATE_RAW;
+	else if (type == tok_comment_begin)
+		*state = STATE_COMMENT;
+	else if (type == tok_block_begin)
+		*state = STATE_BLOCK;
+	else
+		*state = STATE_VARIABLE;
+	return 1;
+}
+
+/**
+ * Tokenize a comment up to the comment end.
+ */
+static int
+Tokenizer_comment(struct Tokenizer *t, int *state)
+{
+	Py_UNICODE *s = t->source;
+	Py_ssize_t i, end;
+
+	for (i = t->pos; i < t->length; i++) {
+		if (s[i] == '-' && match_string(t, i + 1, "#}")) {
+			end = skip_tag_space(t, i + 3);
+			break;
+		}
+		if (s[i] == '#' && i + 1 < t->length && s[i + 1] == '}') {
+			end = i + 2;
+			if (t->trim_blocks && end < t->length && s[end] == '\n')
+				end++;
+			break;
+		}
+	}
+	if (i >= t->length)
+		return Tokenizer_fail(t, PyString_FromString(
+				      "Missing end of comment tag"));
+	if (!Tokenizer_emit(t, tok_comment, i) ||
+	    !Tokenizer_emit(t, tok_comment_end, end))
+		return 0;
+	*state = STATE_ROOT;
+	return 1;
+}
+
+/**
+ * Tokenize the contents of a raw directive up to the endraw tag.
+ */
+static int
+Tokenizer_raw(struct Tokenizer *t, int *state)
+{
+	Py_UNICODE *s = t->source;
+	Py_ssize_t i, j, end = -1;
+
+	for (i = t->pos; i < t->length; i++) {
+		if (IS_TAG_SPACE(s[i])) {
+			j = skip_tag_space(t, i);
+			if (match_string(t, j, "{%-")) {
+				end = match_endraw_tail(t, j + 3);
+				if (end >= 0)
+					break;
+			}
+			i = j - 1;
+			continue;
+		}
+		if (s[i] == '{' && i + 1 < t->length && s[i + 1] == '%') {
+			j = i + 2;
+			if (j < t->length && s[j] == '-')
+				j++;
+			end = match_endraw_tail(t, j);
+			if (end >= 0)
+				break;
+		}
+	}
+	if (end < 0)
+		return Tokenizer_fail(t, PyString_FromString(
+				      "Missing end of raw directive"));
+	if (!Tokenizer_emit(t, tok_data, i) ||
+	    !Tokenizer_emit(t, tok_raw_end, end))
+		return 0;
+	*state = STATE_ROOT;
+	return 1;
+}
+
+/**
+ * Update the brace / parentheses balance for an operator.
+ */
+static int
+Tokenizer_balance(struct Tokenizer *t, Py_UNICODE c)
+{
+	char expected;
+
+	if (c == '{' || c == '(' || c == '[') {
+		if (t->balancing_size == t->balancing_alloc) {
+			char *tmp = PyMem_Realloc(t->balancing,
+						  t->balancing_alloc * 2);
+			if (!tmp) {
+				PyErr_NoMemory();
+				return 0;
+			}
+			t->balancing = tmp;
+			t->balancing_alloc *= 2;
+		}
+		t->balancing[t->balancing_size++] = c == '{' ? '}' :
+						    c == '(' ? ')' : ']';
+	}
+	else if (c == '}' || c == ')' || c == ']') {
+		if (!t->balancing_size)
+			return Tokenizer_fail(t, PyUnicode_FromFormat(
+					      "unexpected \"%c\"", (int)c));
+		expected = t->balancing[--t->balancing_size];
+		if (expected != c)
+			return Tokenizer_fail(t, PyUnicode_FromFormat(
+					      "unexpected \"%c\", expected \"%c\"",
+					      (int)c, (int)expected));
+	}
+	return 1;
+}
+
+/**
+ * Tokenize one token inside of a block or variable tag.
+ */
+static int
+Tokenizer_tag(struct Tokenizer *t, int *state)
+{
+	Py_UNICODE *s = t->source, c = s[t->pos], quote;
+	Py_ssize_t pos = t->pos, end;
+	PyObject *repr, *chr;
+
+	/* the end of the tag if braces are balanced */
+	if (!t->balancing_size) {
+		if (*state == STATE_BLOCK) {
+			if (match_string(t, pos, "-%}"))
+				end = skip_tag_space(t, pos + 3);
+			else if (match_string(t, pos, "%}")) {
+				end = pos + 2;
+				if (t->trim_blocks && end < t->length &&
+				    s[end] == '\n')
+					end++;
+			}
+			else
+				end = -1;
+			if (end >= 0) {
+				*state = STATE_ROOT;
+				return Tokenizer_emit(t, tok_block_end, end);
+			}
+		}
+		else {
+			if (match_string(t, pos, "-}}"))
+				end = skip_tag_space(t, pos + 3);
+			else if (match_string(t, pos, "}}"))
+				end = pos + 2;
+			else
+				end = -1;
+			if (end >= 0) {
+				*state = STATE_ROOT;
+				return Tokenizer_emit(t, tok_variable_end, end);
+			}
+		}
+	}
+
+	/* whitespace */
+	if (Py_UNICODE_ISSPACE(c)) {
+		for (end = pos + 1; end < t->length &&
+		     Py_UNICODE_ISSPACE(s[end]); end++);
+		Tokenizer_advance(t, end);
+		return 1;
+	}
+
+	/* floats and integers */
+	if (IS_DIGIT(c)) {
+		for (end = pos + 1; end < t->length && IS_DIGIT(s[end]); end++);
+		if (end + 1 < t->length && s[end] == '.' &&
+		    IS_DIGIT(s[end + 1])) {
+			for (end += 2; end < t->length && IS_DIGIT(s[end]);
+			     end++);
+			return Tokenizer_emit(t, tok_float, end);
+		}
+		return Tokenizer_emit(t, tok_integer, end);
+	}
+
+	/* names */
+	if (IS_NAME_START(c)) {
+		for (end = pos + 1; end < t->length && IS_NAME_CHAR(s[end]);
+		     end++);
+		return Tokenizer_emit(t, tok_name, end);
+	}
+
+	/* strings. unterminated strings are no strings and end up
+	   as unexpected char below */
+	if (c == '\'' || c == '"') {
+		quote = c;
+		for (end = pos + 1; end < t->length; end++) {
+			if (s[end] == quote)
+				return Tokenizer_emit(t, tok_string, end + 1);
+			if (s[end] == '\\' && ++end >= t->length)
+				break;
+		}
+	}
+
+	/* regular expressions. if there is no end the "@" is
+	   an operator */
+	if (c == '@' && pos + 1 < t->length && s[pos + 1] == '/') {
+		for (end = pos + 2; end < t->length; end++) {
+			if (s[end] == '/') {
+				for (end++; end < t->length &&
+				     s[end] >= 'a' && s[end] <= 'z'; end++);
+				return Tokenizer_emit(t, tok_regex, end);
+			}
+			if (s[end] == '\\' && ++end >= t->length)
+				break;
+		}
+	}
+
+	/* operators */
+	if (pos + 1 < t->length && (
+	    (s[pos + 1] == '=' && (c == '>' || c == '<' || c == '!' ||
+				   c == '=')) ||
+	    (c == '*' && s[pos + 1] == '*') ||
+	    (c == '/' && s[pos + 1] == '/')))
+		return Tokenizer_emit(t, tok_operator, pos + 2);
+	if (c && c < 128 && strchr("+-/*%~!@[](){}=><.:|,", (int)c)) {
+		if (!Tokenizer_balance(t, c))
+			return 0;
+		return Tokenizer_emit(t, tok_operator, pos + 1);
+	}
+
+	/* something went wrong */
+	chr = PyUnicode_FromUnicode(s + pos, 1);
+	if (!chr)
+		return 0;
+	repr = PyObject_Repr(chr);
+	Py_DECREF(chr);
+	if (!repr)
+		return 0;
+	chr = PyString_FromFormat("unexpected char %s at %zd",
+				  PyString_AS_STRING(repr), pos);
+	Py_DECREF(repr);
+	return Tokenizer_fail(t, chr);
+}
+
+/**
+ * Tokenize a template that uses the default delimiters.
+ *
+ * Takes the normalized unicode source and the trim_blocks flag and
+ * returns a tuple in the form ``(tokens, error)``. Tokens is a list of
+ * ``(lineno, type, value)`` tuples as yielded by `Lexer.tokeniter`, error
+ * is `None` or a ``(lineno, message)`` tuple for a syntax error that
+ * happened after the last token.
+ */
+static PyObject*
+tokenize(PyObject *self, PyObject *args)
+{
+	PyObject *source, *result = NULL;
+	struct Tokenizer t;
+	int trim_blocks = 0, state = STATE_ROOT, ok = 1;
+
+	if (!PyArg_ParseTuple(args, "U|i:tokenize", &source, &trim_blocks))
+		return NULL;
+
+	t.source = PyUnicode_AS_UNICODE(source);
+	t.length = PyUnicode_GET_SIZE(source);
+	t.pos = 0;
+	t.lineno = 1;
+	t.trim_blocks = trim_blocks;
+	t.error = NULL;
+	t.balancing_size = 0;
+	t.balancing_alloc = 16;
+	t.balancing = PyMem_Malloc(t.balancing_alloc);
+	if (!t.balancing)
+		return PyErr_NoMemory();
+	t.tokens = PyList_New(0);
+	if (!t.tokens)
+		goto done;
+
+	while (ok && t.pos < t.length) {
+		switch (state) {
+		case STATE_ROOT:
+			ok = Tokenizer_root(&t, &state);
+			break;
+		case STATE_COMMENT:
+			ok = Tokenizer_comment(&t, &state);
+			break;
+		case STATE_RAW:
+			ok = Tokenizer_raw(&t, &state);
+			break;
+		default:
+			ok = Tokenizer_tag(&t, &state);
+		}
+	}
+
+	/* a syntax error is returned, everything else is raised */
+	if (!ok && !t.error)
+		goto done;
+	result = Py_BuildValue("(OO)", t.tokens, t.error ? t.error : Py_None);
+
+done:
+	Py_XDECREF(t.tokens);
+	Py_XDECREF(t.error);
+	PyMem_Free(t.balancing);
+	return result;
+}
+
 static PyMethodDef module_methods[] = {
+	{"tokenize", (PyCFunction)tokenize, METH_VARARGS,
+	 "tokenize(source[, trim_blocks]) -> (tokens, error)\n\n"
+	 "Tokenize a template with the default delimiters."},
 	{NULL, NULL, 0, NULL}		/* Sentinel */
 };
 
@@ -487,7 +1048,7 @@ init_speedups(void)
 	if (PyType_Ready(&BaseContextType) < 0)
 		return;
 
-	if (!init_constants())
+	if (!init_constants() || !init_tokenizer())
 		return;
 
 	module = Py_InitModule3("_speedups", module_methods, "");
@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.bccache
+    ~~~~~~~~~~~~~
+
+    Bytecode caches for the caching loaders.  A bytecode cache stores the
+    dumped templates by a key.  The `cache_folder` of the loaders is a
+    `FileSystemBytecodeCache` and the `MemcachedLoaderMixin` stores the
+    templates with a `MemcachedBytecodeCache`.  Other caches can be passed
+    to the `FileSystemLoader`, `PackageLoader` and `FunctionLoader` (or any
+    loader using the `CachedLoaderMixin`) as `bytecode_cache`:
+
+    .. sourcecode:: python
+
+        from jinja import Environment, FileSystemLoader
+        from jinja.bccache import MemcachedBytecodeCache
+
+        env = Environment(loader=FileSystemLoader('templates',
+            bytecode_cache=MemcachedBytecodeCache(client)))
+
+    Prefork servers can use the `SharedMemoryBytecodeCache` so that the
+    worker processes reuse the templates compiled by the other workers.
+
+    To store the bytecode somewhere else subclass `BytecodeCache` and
+    implement `load_bytecode`, `dump_bytecode` and `clear`.  The other
+    methods are optional.  The methods can be called from multiple threads
+    at once.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import struct
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from os import path
+from fnmatch import fnmatch
+from threading import Lock, Thread
+from jinja.translators.python import Template
+from jinja.utils import CacheDict, write_atomically
+
+
+__all__ = ['BytecodeCache', 'FileSystemBytecodeCache',
+           'MemcachedBytecodeCache', 'MemoryBytecodeCache',
+           'SharedMemoryBytecodeCache']
+
+
+# the header of the shared memory file (magic, number of slots, size of
+# the file and end of the used data) and of the slots (sha1 digest of
+# the key, offset and size of the bytecode)
+shm_magic = 'JNJS'
+shm_header = '<4sIII'
+shm_header_size = struct.calcsize(shm_header)
+shm_slot = '<20sII'
+shm_slot_size = struct.calcsize(shm_slot)
+shm_empty_digest = '\0' * 20
+
+
+class BytecodeCache(object):
+    """
+    Baseclass for the bytecode caches.  The keys the caching loaders use
+    are ascii strings that are safe to use in filenames.
+    """
+
+    def load_bytecode(self, key):
+        """
+        Return the bytecode stored for `key` or `None`.
+        """
+        raise NotImplementedError()
+
+    def dump_bytecode(self, key, bytecode):
+        """
+        Store the bytecode for `key`.
+        """
+        raise NotImplementedError()
+
+    def remove_bytecode(self, key):
+        """
+        Remove the bytecode stored for `key`.  Does nothing by default.
+        """
+
+    def clear(self):
+        """
+        Remove all the bytecode from the cache.
+        """
+        raise NotImplementedError()
+
+    def load_template(self, environment, key):
+        """
+        Return the template stored for `key` or `None` if it's not there
+        or was dumped by another python or Jinja version.
+        """
+        bytecode = self.load_bytecode(key)
+        if not bytecode:
+            return None
+        try:
+            return Template.load(environment, bytecode)
+        except (ValueError, EOFError):
+            return None
+
+    def acquire(self, key):
+        """
+        Lock `key` against other processes while the template is compiled.
+        Returns `True` if the key was locked, in that case the caller has
+        to look for the template again and call `release` afterwards.  The
+        default implementation doesn't lock and returns `False`.
+        """
+        return False
+
+    def release(self, key):
+        """
+        Unlock a key locked by `acquire`.
+        """
+
+
+class CacheFolderLock(object):
+    """
+    Advisory locks for the keys in a cache folder that are shared by all
+    the processes using the folder.  Each key locks one byte of the lock
+    file.  If `fcntl` is not available or the file system doesn't support
+    locking nothing is locked.
+
+    The locks belong to the process, the threads of a process are not
+    locked against each other.
+    """
+
+    #: the number of lockable bytes in the lock file
+    lock_range = 1 << 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self._lock = Lock()
+
+    def _get_fd(self):
+        if self._fd is None:
+            self._lock.acquire()
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.filename, os.O_RDWR |
+                                       os.O_CREAT, 0666)
+            finally:
+                self._lock.release()
+        return self._fd
+
+    def _lockf(self, key, operation):
+        try:
+            import fcntl
+            fcntl.lockf(self._get_fd(), getattr(fcntl, operation), 1,
+                        int(sha1(key).hexdigest()[:8], 16) %
+                        self.lock_range)
+        except (ImportError, EnvironmentError):
+            pass
+
+    def acquire(self, key):
+        """Lock `key`."""
+        self._lockf(key, 'LOCK_EX')
+
+    def release(self, key):
+        """Unlock `key`."""
+        self._lockf(key, 'LOCK_UN')
+
+
+class FileSystemBytecodeCache(BytecodeCache):
+    """
+    Stores the bytecode in files in `directory`.  The filenames are built
+    from the keys with `pattern`.  The default pattern is the same as the
+    one of the `cache_folder` of the loaders.  The files are written
+    atomically and the processes sharing the directory lock the keys they
+    compile, so that each template is compiled only once.
+
+    The size of the directory can be limited with `max_size` (in bytes),
+    `max_entries` and `max_age` (in seconds since the last use of a file).
+    After writing a file the cache removes old files in a background
+    thread, at most once in `prune_interval` seconds.  `prune` does the
+    same right away.
+    """
+
+    #: the minimum number of seconds between two automatic prunes
+    prune_interval = 60
+
+    def __init__(self, directory, pattern='jinja_%s.cache', max_size=None,
+                 max_entries=None, max_age=None):
+        self.directory = directory
+        self.pattern = pattern
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._folder_lock = CacheFolderLock(path.join(directory,
+                                                      '.jinja_cache.lock'))
+        self._lock = Lock()
+        self._last_prune = 0
+        self._pruning = False
+
+    def get_filename(self, key):
+        return path.join(self.directory, self.pattern % key)
+
+    def load_bytecode(self, key):
+        try:
+            f = file(self.get_filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def load_template(self, environment, key):
+        # the file is memory mapped by `Template.load`
+        try:
+            f = file(self.get_filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return Template.load(environment, f)
+            except (ValueError, EOFError):
+                return None
+        finally:
+            f.close()
+
+    def dump_bytecode(self, key, bytecode):
+        write_atomically(self.get_filename(key), bytecode)
+        self._schedule_prune()
+
+    def remove_bytecode(self, key):
+        try:
+            os.remove(self.get_filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        pattern = self.pattern % '*'
+        for filename in os.listdir(self.directory):
+            if fnmatch(filename, pattern):
+                try:
+                    os.remove(path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    def acquire(self, key):
+        self._folder_lock.acquire(key)
+        return True
+
+    def release(self, key):
+        self._folder_lock.release(key)
+
+    def prune(self):
+        """
+        Remove the files not used for `max_age` seconds and then the least
+        recently used ones until the directory has at most `max_entries`
+        files of at most `max_size` bytes in total.  Temporary files left
+        behind by crashed processes are removed too.  Returns the number
+        of removed files.
+
+        The last use of a file is its access time or, if the file system
+        doesn't record access times, its modification time.
+        """
+        pattern = self.pattern % '*'
+        now = time.time()
+        entries = []
+        removed = 0
+        for filename in os.listdir(self.directory):
+            if fnmatch(filename, pattern + '.*.tmp'):
+                temporary = True
+            elif fnmatch(filename, pattern):
+                temporary = False
+            else:
+                continue
+            filename = path.join(self.directory, filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            last_used = max(st.st_atime, st.st_mtime)
+            if temporary:
+                expired = now - st.st_mtime > 60 * 60
+            else:
+                expired = self.max_age is not None and \
+                          now - last_used > self.max_age
+                if not expired:
+                    entries.append((last_used, st.st_size, filename))
+            if expired:
+                try:
+                    os.remove(filename)
+                    removed += 1
+                except OSError:
+                    pass
+
+        entries.sort()
+        size = 0
+        for entry in entries:
+            size += entry[1]
+        count = len(entries)
+        for last_used, entry_size, filename in entries:
+            if (self.max_entries is None or count <= self.max_entries) and \
+               (self.max_size is None or size <= self.max_size):
+                break
+            try:
+                os.remove(filename)
+                removed += 1
+            except OSError:
+                pass
+            count -= 1
+            size -= entry_size
+        return removed
+
+    def _schedule_prune(self):
+        """
+        Prune the directory in a background thread if it has limits and
+        wasn't pruned in the last `prune_interval` seconds.
+        """
+        if (self.max_size, self.max_entries, self.max_age) == \
+           (None, None, None):
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self._pruning or now - self._last_prune < \
+               self.prune_interval:
+                return
+            self._pruning = True
+            self._last_prune = now
+        finally:
+            self._lock.release()
+        def prune():
+            try:
+                self.prune()
+            finally:
+                self._pruning = False
+        thread = Thread(target=prune)
+        thread.setDaemon(True)
+        thread.start()
+
+
+class MemcachedBytecodeCache(BytecodeCache):
+    """
+    Stores the bytecode on memcached servers.  `client` is a memcache
+    client (for example from the `memcache` module), the keys are
+    prefixed with `prefix` and expire after `timeout` seconds (``0`` means
+    never).  The client calls are serialized because memcache clients are
+    not required to be thread safe.
+
+    Because memcached can't remove keys by a prefix `clear` does nothing.
+    `load_many` and `dump_many` transfer many items with one request if
+    the client has `get_multi` and `set_multi` methods.
+    """
+
+    def __init__(self, client, prefix='jinja/bytecode/', timeout=0):
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self._lock = Lock()
+
+    def load_bytecode(self, key):
+        self._lock.acquire()
+        try:
+            return self.client.get(self.prefix + key)
+        finally:
+            self._lock.release()
+
+    def dump_bytecode(self, key, bytecode):
+        self._lock.acquire()
+        try:
+            self.client.set(self.prefix + key, bytecode, self.timeout)
+        finally:
+            self._lock.release()
+
+    def remove_bytecode(self, key):
+        self._lock.acquire()
+        try:
+            if hasattr(self.client, 'delete'):
+                self.client.delete(self.prefix + key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        pass
+
+    def load_many(self, keys):
+        """
+        Return a dict with the bytecode stored for the `keys`.  Missing
+        keys are not in the dict.
+        """
+        self._lock.acquire()
+        try:
+            if hasattr(self.client, 'get_multi'):
+                found = self.client.get_multi([self.prefix + key
+                                               for key in keys])
+            else:
+                found = {}
+                for key in keys:
+                    bytecode = self.client.get(self.prefix + key)
+                    if bytecode:
+                        found[self.prefix + key] = bytecode
+        finally:
+            self._lock.release()
+        rv = {}
+        for key in keys:
+            if found.get(self.prefix + key):
+                rv[key] = found[self.prefix + key]
+        return rv
+
+    def dump_many(self, mapping):
+        """
+        Store the bytecode in `mapping` which maps keys to bytecode.
+        """
+        self._lock.acquire()
+        try:
+            if hasattr(self.client, 'set_multi'):
+                self.client.set_multi(dict([(self.prefix + key, bytecode)
+                                            for key, bytecode
+                                            in mapping.iteritems()]),
+                                      self.timeout)
+            else:
+                for key, bytecode in mapping.iteritems():
+                    self.client.set(self.prefix + key, bytecode,
+                                    self.timeout)
+        finally:
+            self._lock.release()
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """
+    Stores the bytecode in the process.  If `size` is given only the last
+    `size` templates are kept.  Mainly useful for testing and for sharing
+    bytecode between loaders and environments.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            self._cache = {}
+        else:
+            self._cache = CacheDict(size)
+        self._lock = Lock()
+
+    def load_bytecode(self, key):
+        self._lock.acquire()
+        try:
+            return self._cache.get(key)
+        finally:
+            self._lock.release()
+
+    def dump_bytecode(self, key, bytecode):
+        self._lock.acquire()
+        try:
+            self._cache[key] = bytecode
+        finally:
+            self._lock.release()
+
+    def remove_bytecode(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._cache:
+                del self._cache[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+class SharedMemoryBytecodeCache(BytecodeCache):
+    """
+    Stores the bytecode in a memory mapped file that is shared by all the
+    processes using the same `filename`, for example the workers of a
+    prefork server.  The file has a hash table with `slots` entries and
+    is `size` bytes big.  If the bytecode doesn't fit any more the cache
+    is cleared.  The processes lock the file with `fcntl.lockf`, so this
+    cache is only available on unix systems.  Because these locks belong
+    to the process the cache can be created before forking the workers.
+
+    The file is created if it doesn't exist and reinitialized if it was
+    created with another size or number of slots, so all processes have
+    to use the same values.
+    """
+
+    def __init__(self, filename, size=16 * 1024 * 1024, slots=4096):
+        import fcntl
+        from mmap import mmap
+        self._lockf = fcntl.lockf
+        self._lock_sh = fcntl.LOCK_SH
+        self._lock_ex = fcntl.LOCK_EX
+        self._lock_un = fcntl.LOCK_UN
+        self.filename = filename
+        self.size = size
+        self.slots = slots
+        self._data_start = shm_header_size + slots * shm_slot_size
+        if self._data_start >= size:
+            raise ValueError('size too small for %d slots' % slots)
+        self._lock = Lock()
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        self._acquire(True)
+        try:
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap(self._fd, size)
+            header = struct.unpack(shm_header, self._map[:shm_header_size])
+            if header[:3] != (shm_magic, slots, size):
+                self._clear()
+        finally:
+            self._release()
+
+    def _acquire(self, exclusive):
+        self._lock.acquire()
+        try:
+            self._lockf(self._fd, exclusive and self._lock_ex or
+                        self._lock_sh)
+        except:
+            self._lock.release()
+            raise
+
+    def _release(self):
+        try:
+            self._lockf(self._fd, self._lock_un)
+        finally:
+            self._lock.release()
+
+    def _clear(self):
+        """Reset the file.  The exclusive lock must be held."""
+        self._map[:self._data_start] = struct.pack(shm_header, shm_magic,
+            self.slots, self.size, self._data_start) + \
+            '\0' * (self._data_start - shm_header_size)
+
+    def _find_slot(self, digest):
+        """
+        Return the position of the slot for `digest` and the slot data.
+        The slot is either the one of the digest or the first empty one
+        after it, `None` is returned for a full table.
+        """
+        index = struct.unpack('<I', digest[:4])[0] % self.slots
+        for x in xrange(self.slots):
+            pos = shm_header_size + ((index + x) % self.slots) * \
+                  shm_slot_size
+            slot = struct.unpack(shm_slot, self._map[pos:pos +
+                                                     shm_slot_size])
+            if slot[0] == digest or slot[0] == shm_empty_digest:
+                return pos, slot
+        return None, None
+
+    def load_bytecode(self, key):
+        digest = sha1(key).digest()
+        self._acquire(False)
+        try:
+            pos, slot = self._find_slot(digest)
+            if pos is None or slot[0] != digest:
+                return None
+            return self._map[slot[1]:slot[1] + slot[2]]
+        finally:
+            self._release()
+
+    def dump_bytecode(self, key, bytecode):
+        if self._data_start + len(bytecode) > self.size:
+            return
+        digest = sha1(key).digest()
+        self._acquire(True)
+        try:
+            data_end = struct.unpack(shm_header,
+                                     self._map[:shm_header_size])[3]
+            pos, slot = self._find_slot(digest)
+            if pos is None or data_end + len(bytecode) > self.size:
+                self._clear()
+                data_end = self._data_start
+                pos, slot = self._find_slot(digest)
+            self._map[data_end:data_end + len(bytecode)] = bytecode
+            self._map[pos:pos + shm_slot_size] = struct.pack(shm_slot,
+                digest, data_end, len(bytecode))
+            self._map[:shm_header_size] = struct.pack(shm_header, shm_magic,
+                self.slots, self.size, data_end + len(bytecode))
+        finally:
+            self._release()
+
+    def clear(self):
+        self._acquire(True)
+        try:
+            self._clear()
+        finally:
+            self._release()
+
+    def close(self):
+        """Unmap and close the file."""
+        self._map.close()
+        os.close(self._fd)
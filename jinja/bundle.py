@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.bundle
+    ~~~~~~~~~~~~
+
+    A bundle is a single file with the compiled code of many templates.
+    Instead of one cache file per template (as the `cache_folder` of the
+    caching loaders creates them) an application can ship one bundle and
+    load it with the `BundleLoader`.
+
+    The file starts with a header made of the `bundle_magic`, the magic
+    number of the python interpreter that compiled the templates, the
+    start of the sha1 digest of the Jinja version and the offset and size
+    of the index.  The index is a marshalled dict that
+    maps the template names to ``(offset, size, dependencies)`` tuples.
+    The entries are the templates as dumped by `Template.dump`.
+
+    Bundles are created with `jinja.precompile.build_bundle` or the
+    ``--bundle`` option of the ``jinja-precompile`` script.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import imp
+import mmap
+import struct
+from marshal import loads, dumps
+from jinja.translators.python import Template, _get_version_digest
+
+
+__all__ = ['Bundle', 'write_bundle']
+
+
+#: the first bytes of every bundle file
+bundle_magic = 'JNJB'
+
+# the header after the magic: interpreter magic, jinja version digest,
+# index offset and size
+bundle_header = '<4s8sII'
+bundle_header_size = len(bundle_magic) + struct.calcsize(bundle_header)
+
+
+def write_bundle(filename, templates):
+    """
+    Write a bundle.  `templates` is a list of ``(name, data)`` tuples
+    where `data` is the string returned by `Template.dump`.
+    """
+    f = file(filename, 'wb')
+    try:
+        f.write('\0' * bundle_header_size)
+        offset = bundle_header_size
+        index = {}
+        for name, data in templates:
+            dependencies = Template.load(None, data).dependencies
+            index[name] = (offset, len(data), dependencies)
+            f.write(data)
+            offset += len(data)
+        index = dumps(index)
+        f.write(index)
+        f.seek(0)
+        f.write(bundle_magic + struct.pack(bundle_header, imp.get_magic(),
+                                           _get_version_digest(), offset,
+                                           len(index)))
+    finally:
+        f.close()
+
+
+class Bundle(object):
+    """
+    Read access to a bundle.  The file is memory mapped and only the
+    index is unmarshalled when the bundle is opened, the entries are read
+    by `get_data` when requested.  Raises a `ValueError` if the file is
+    not a bundle or if it was created by another python or Jinja version.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        f = file(filename, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        header = self._map[:bundle_header_size]
+        if len(header) != bundle_header_size or \
+           header[:len(bundle_magic)] != bundle_magic:
+            self.close()
+            raise ValueError('%r is not a template bundle' % filename)
+        magic, version, offset, size = struct.unpack(bundle_header,
+            header[len(bundle_magic):])
+        if magic != imp.get_magic():
+            self.close()
+            raise ValueError('%r was created by another python version' %
+                             filename)
+        if version != _get_version_digest():
+            self.close()
+            raise ValueError('%r was created by another jinja version' %
+                             filename)
+        self._index = loads(self._map[offset:offset + size])
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def names(self):
+        """Return a sorted list of the template names."""
+        rv = self._index.keys()
+        rv.sort()
+        return rv
+
+    def get_dependencies(self, name):
+        """
+        Return the dependencies of a template without loading it.  Raises
+        a `KeyError` if the template is not in the bundle.
+        """
+        return self._index[name][2]
+
+    def get_data(self, name):
+        """
+        Return the dumped template.  Raises a `KeyError` if the template
+        is not in the bundle.
+        """
+        offset, size, dependencies = self._index[name]
+        return self._map[offset:offset + size]
+
+    def close(self):
+        """Unmap the file."""
+        self._map.close()
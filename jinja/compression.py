@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.compression
+    ~~~~~~~~~~~~~~~~~
+
+    Compression of dumped templates for the disk and memcached caches.
+
+    A codec is an object with a unique one character `id` and two methods
+    `compress` and `decompress` that take and return strings.  Compressed
+    data starts with a null byte (which is never the first byte of
+    marshalled data) followed by the id of the codec, so compressed and
+    uncompressed data can be mixed in a cache:
+
+    .. sourcecode:: python
+
+        from jinja.compression import register_codec
+
+        class LZ4Codec(object):
+            id = 'l'
+            def compress(self, data):
+                return lz4.compress(data)
+            def decompress(self, data):
+                return lz4.decompress(data)
+
+        register_codec(LZ4Codec())
+
+    The codecs have to be registered so that `decompress` can find them.
+    The `ZlibCodec` is registered by default.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+
+
+__all__ = ['ZlibCodec', 'register_codec', 'get_codec', 'compress',
+           'decompress', 'is_compressed']
+
+
+#: the first byte of compressed data
+compression_marker = '\0'
+
+#: the registered codecs by id
+_codecs = {}
+
+
+class ZlibCodec(object):
+    """
+    Compresses with the zlib module of the standard library.
+    """
+    id = 'z'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        from zlib import compress
+        return compress(data, self.level)
+
+    def decompress(self, data):
+        from zlib import decompress
+        return decompress(data)
+
+
+def register_codec(codec):
+    """
+    Register a codec so that data compressed by it can be decompressed.
+    """
+    if len(codec.id) != 1:
+        raise ValueError('codec ids must be one character long')
+    _codecs[codec.id] = codec
+
+
+def get_codec(codec):
+    """
+    Helper for the loaders.  Return `None` for a false value, the default
+    codec (zlib) for ``True`` and the codec itself otherwise.
+    """
+    if not codec:
+        return None
+    if codec is True:
+        return _codecs[ZlibCodec.id]
+    return codec
+
+
+def compress(data, codec, threshold=0):
+    """
+    Compress `data` with `codec` if it's at least `threshold` bytes long
+    and the compressed data is smaller.  Otherwise return it unchanged.
+    """
+    if len(data) < threshold:
+        return data
+    rv = compression_marker + codec.id + codec.compress(data)
+    if len(rv) >= len(data):
+        return data
+    return rv
+
+
+def is_compressed(data):
+    """Check if `data` was compressed by `compress`."""
+    return data[:1] == compression_marker
+
+
+def decompress(data):
+    """
+    Decompress data returned by `compress`.  Raises a `ValueError` if the
+    codec is unknown.
+    """
+    if not is_compressed(data):
+        return data
+    codec = _codecs.get(data[1:2])
+    if codec is None:
+        raise ValueError('unknown compression codec %r' % data[1:2])
+    return codec.decompress(data[2:])
+
+
+register_codec(ZlibCodec())
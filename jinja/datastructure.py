@@ -496,12 +496,16 @@ class StateTest(object):
 class Token(object):
     """
     Token class.
+
+    The type of the token is not converted or interned, the lexer takes
+    care of yielding interned bytestrings so that creating a token is
+    as cheap as possible.
     """
     __slots__ = ('lineno', 'type', 'value')
 
     def __init__(self, lineno, type, value):
         self.lineno = lineno
-        self.type = intern(str(type))
+        self.type = type
         self.value = value
 
     def __str__(self):
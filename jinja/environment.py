@@ -8,15 +8,17 @@
     :copyright: 2007 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
+from threading import Lock
 from jinja.lexer import Lexer
 from jinja.parser import Parser
 from jinja.loaders import LoaderWrapper
 from jinja.datastructure import SilentUndefined, Markup, Context, FakeTranslator
 from jinja.translators.python import PythonTranslator 
-from jinja.utils import collect_translations, get_attribute
+from jinja.utils import collect_translations, get_attribute, CacheDict
 from jinja.exceptions import FilterNotFound, TestNotFound, \
      SecurityException, TemplateSyntaxError
 from jinja.defaults import DEFAULT_FILTERS, DEFAULT_TESTS, DEFAULT_NAMESPACE
+from jinja import nodes
 
 
 __all__ = ['Environment']
@@ -25,6 +27,10 @@ __all__ = ['Environment']
 #: minor speedup
 _getattr = getattr
 
+#: the settings that can be changed after the environment initialization
+#: and change the code of the templates
+_code_settings = ('template_charset', 'disable_regexps', 'inline_filters')
+
 
 class Environment(object):
     """
@@ -56,7 +62,9 @@ class Environment(object):
                  disable_regexps=False,
                  friendly_traceback=True,
                  translator_factory=None,
-                 template_translator=PythonTranslator):
+                 template_translator=PythonTranslator,
+                 from_string_cache_size=50,
+                 inline_filters=False):
         """
         Here the possible initialization parameters:
 
@@ -123,6 +131,16 @@ class Environment(object):
                                   process which can be used to process the 
                                   template's AST into a compiled python module.
                                   *new in Jinja 1.2*
+        `from_string_cache_size`  The number of templates `from_string`
+                                  keeps compiled. Set this to ``0`` to
+                                  disable the cache. Defaults to ``50``.
+                                  *new in Jinja 1.3*
+        `inline_filters`          If this is ``True`` filters with constant
+                                  arguments are created once per template
+                                  instead of once per rendering and called
+                                  directly. Filters registered or replaced
+                                  after a template was loaded are not seen
+                                  by that template. *new in Jinja 1.3*
         ========================= ============================================
 
         All of these variables except those marked with a star (*) are
@@ -153,6 +171,7 @@ class Environment(object):
         self.undefined_singleton = undefined_singleton
         self.disable_regexps = disable_regexps
         self.friendly_traceback = friendly_traceback
+        self.inline_filters = inline_filters
 
         # global namespace
         if namespace is None:
@@ -173,6 +192,15 @@ class Environment(object):
         # create lexer
         self.lexer = Lexer(self)
 
+        # cache for the templates created by from_string
+        if from_string_cache_size:
+            self.from_string_cache = CacheDict(from_string_cache_size)
+        else:
+            self.from_string_cache = None
+        self.from_string_cache_hits = 0
+        self.from_string_cache_misses = 0
+        self._from_string_lock = Lock()
+
     def loader(self, value):
         """
         Get or set the template loader.
@@ -207,11 +235,29 @@ class Environment(object):
         Load and parse a template source and translate it into eval-able
         Python code. This code is wrapped within a `Template` class that
         allows you to render it.
+
+        Templates that neither extend nor include other templates are
+        kept in a cache (see `from_string_cache_size`), the number of
+        cache hits and misses is stored in `from_string_cache_hits` and
+        `from_string_cache_misses`.
         """
         from jinja.translators.python import PythonTranslator
+        cache = self.from_string_cache
+        if cache is not None:
+            key = (source,) + tuple([_getattr(self, name) for name
+                                     in _code_settings])
+            self._from_string_lock.acquire()
+            try:
+                rv = cache.get(key)
+                if rv is not None:
+                    self.from_string_cache_hits += 1
+                    return rv
+                self.from_string_cache_misses += 1
+            finally:
+                self._from_string_lock.release()
         try:
-            rv = PythonTranslator.process(self, Parser(self, source).parse(),
-                                          source)
+            node = Parser(self, source).parse()
+            rv = PythonTranslator.process(self, node, source)
         except TemplateSyntaxError, e:
             # on syntax errors rewrite the traceback if wanted
             if not self.friendly_traceback:
@@ -220,8 +266,20 @@ class Environment(object):
             if __debug__:
                 __traceback_hide__ = True
             raise_syntax_error(e, self, source)
-        else:
-            return rv
+
+        # templates that extend or include other templates contain the
+        # code of those which could change through the loader, so we
+        # don't cache them.
+        if cache is not None and node.extends is None:
+            for include in nodes.get_nodes(nodes.Include, node):
+                break
+            else:
+                self._from_string_lock.acquire()
+                try:
+                    cache[key] = rv
+                finally:
+                    self._from_string_lock.release()
+        return rv
 
     def get_template(self, filename):
         """
@@ -295,6 +353,19 @@ class Environment(object):
             value = func(self, context, value)
         return value
 
+    def resolve_filter(self, filtername, args):
+        """
+        Create the filter `filtername` with the arguments `args`.  Used by
+        templates compiled with `inline_filters`.  For unknown filters a
+        function that raises `FilterNotFound` is returned so that the error
+        happens when the filter is used, not when the template is loaded.
+        """
+        if filtername not in self.filters:
+            def missing(env, context, value):
+                raise FilterNotFound(filtername)
+            return missing
+        return self.filters[filtername](*args)
+
     def perform_test(self, context, testname, args, value):
         """
         Perform a test on a variable.
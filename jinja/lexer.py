@@ -24,6 +24,7 @@
 """
 import re
 import unicodedata
+from bisect import bisect_left
 from jinja.datastructure import TokenStream, Token
 from jinja.exceptions import TemplateSyntaxError
 from jinja.utils import set, sorted
@@ -37,15 +38,28 @@ __all__ = ['Lexer', 'Failure', 'keywords']
 # environments with the same lexer
 _lexer_cache = WeakValueDictionary()
 
-
-# static regular expressions
-whitespace_re = re.compile(r'\s+(?um)')
+# the tokenizer of the speedups module only supports the default delimiters
+# (block, variable and comment start and end strings)
+default_delimiters = ('{%', '%}', '{{', '}}', '{#', '#}')
+try:
+    from jinja._speedups import tokenize as native_tokenize
+except ImportError:
+    native_tokenize = None
+
+
+# static regular expressions. the whitespace rule spells out the unicode
+# whitespace characters because the rules of a lexer state are combined
+# into one regular expression and the unicode flag would change the
+# meaning of other rules too.
+whitespace_re = re.compile(u'[\t-\r\x1c- \x85\xa0\u1680\u180e\u2000-\u200a'
+                           u'\u2028\u2029\u202f\u205f\u3000]+')
 name_re = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
 string_re = re.compile(r"('([^'\\]*(?:\\.[^'\\]*)*)'"
                        r'|"([^"\\]*(?:\\.[^"\\]*)*)")(?ms)')
-integer_re = re.compile(r'\d+')
-float_re = re.compile(r'\d+\.\d+')
+integer_re = re.compile(r'[0-9]+')
+float_re = re.compile(r'[0-9]+\.[0-9]+')
 regex_re = re.compile(r'\@/([^/\\]*(?:\\.[^/\\]*)*)*/[a-z]*(?ms)')
+newline_re = re.compile(r'\n')
 
 
 # set of used keywords
@@ -196,6 +210,42 @@ class Failure(object):
         raise self.error_class(self.message, lineno, filename)
 
 
+def combine_rules(rules):
+    """
+    Combine the rules of a lexer state into one regular expression. Every
+    rule is wrapped in a named group so that the tokenizer can use the
+    `lastgroup` of the match to find the rule that matched. Because the
+    alternation tries the rules from the left to the right the first rule
+    that matches wins, exactly like trying them one after another.
+
+    Returns a tuple in the form ``(regex, actions)`` where actions is a
+    dict that maps the group names to ``(offset, tokens, new_state,
+    named_groups)`` tuples. The offset is the group index of the wrapping
+    group, the groups of the rule itself are numbered relative to it.
+    """
+    patterns = []
+    flags = 0
+    offset = 1
+    rule_offsets = []
+    for regex, tokens, new_state in rules:
+        patterns.append('(?P<_rule%d>%s)' % (len(patterns), regex.pattern))
+        flags |= regex.flags
+        rule_offsets.append(offset)
+        offset += regex.groups + 1
+    combined = re.compile('|'.join(patterns), flags)
+
+    actions = {}
+    for idx, (regex, tokens, new_state) in enumerate(rules):
+        # named groups are not renumbered, but because dict order is
+        # random we sort them by their position in the rule. The names
+        # are yielded as token types, so intern them.
+        named_groups = [intern(name) for name, pos in
+                        sorted(regex.groupindex.items(), key=lambda x: x[1])]
+        actions['_rule%d' % idx] = (rule_offsets[idx], tokens, new_state,
+                                    named_groups)
+    return combined, actions
+
+
 class LexerMeta(type):
     """
     Metaclass for the lexer that caches instances for
@@ -215,8 +265,10 @@ class LexerMeta(type):
         if key in _lexer_cache:
             return _lexer_cache[key]
 
-        # create a new lexer and cache it
+        # create a new lexer and cache it.  the key is also used by the
+        # parser to cache the trees of templates
         lexer = type.__call__(cls, environment)
+        lexer.config_key = key
         _lexer_cache[key] = lexer
         return lexer
 
@@ -334,6 +386,27 @@ class Lexer(object):
                 )), 'variable_end', '#pop')
             ] + tag_rules
 
+        # combine the rules of each state into one regular expression.
+        # if braces or parentheses are not balanced the end tags must not
+        # match, so there is a second version without those rules.
+        self.combined_rules = {}
+        for state, rules in self.rules.iteritems():
+            self.combined_rules[state] = combine_rules(rules) + \
+                combine_rules([rule for rule in rules if rule[1] not in
+                               ('variable_end', 'block_end')])
+
+        #: if the speedups module is compiled and the environment uses the
+        #: default delimiters unicode sources are tokenized in C.
+        self.native = native_tokenize is not None and (
+            environment.block_start_string,
+            environment.block_end_string,
+            environment.variable_start_string,
+            environment.variable_end_string,
+            environment.comment_start_string,
+            environment.comment_end_string
+        ) == default_delimiters
+        self.trim_blocks = environment.trim_blocks
+
     def tokenize(self, source, filename=None):
         """
         Works like `tokeniter` but returns a tokenstream of tokens and not a
@@ -354,7 +427,7 @@ class Lexer(object):
                 elif token == 'name':
                     value = str(value)
                     if value in keywords:
-                        token = value
+                        token = intern(value)
                         value = ''
                 elif token == 'string':
                     value = unescape_string(lineno, filename, value[1:-1])
@@ -386,133 +459,150 @@ class Lexer(object):
         keywords instead of just names.
         """
         source = '\n'.join(source.splitlines())
+
+        # the native tokenizer returns the tokens up to the first syntax
+        # error and the error, so that we can yield them first like the
+        # python tokenizer does.
+        if self.native and isinstance(source, unicode):
+            tokens, error = native_tokenize(source, self.trim_blocks)
+            for token in tokens:
+                yield token
+            if error is not None:
+                raise TemplateSyntaxError(error[1], error[0], filename)
+            return
+
         pos = 0
-        lineno = 1
         stack = ['root']
-        statetokens = self.rules['root']
+        regex, actions, balanced_regex, balanced_actions = \
+            self.combined_rules['root']
         source_length = len(source)
 
         balancing_stack = []
 
+        # the offsets of all newlines in the source. the line number of
+        # a token is looked up with a binary search when it's yielded, so
+        # the text of the tokens is never scanned for newlines.
+        newlines = [m.start() for m in newline_re.finditer(source)]
+
         while True:
-            # tokenizer loop
-            for regex, tokens, new_state in statetokens:
+            # tokenizer loop. we only match blocks and variables if braces
+            # and parentheses are balanced. if they are not we use the
+            # version of the state rules without the end tags which means
+            # that the end tags are tokenized by the operator rule.
+            if balancing_stack:
+                m = balanced_regex.match(source, pos)
+                if m is not None:
+                    offset, tokens, new_state, named_groups = \
+                        balanced_actions[m.lastgroup]
+            else:
                 m = regex.match(source, pos)
-                # if no match we try again with the next rule
-                if not m:
-                    continue
-
-                # we only match blocks and variables if brances / parentheses
-                # are balanced. continue parsing with the lower rule which
-                # is the operator rule. do this only if the end tags look
-                # like operators
-                if balancing_stack and \
-                   tokens in ('variable_end', 'block_end'):
-                    continue
+                if m is not None:
+                    offset, tokens, new_state, named_groups = \
+                        actions[m.lastgroup]
 
-                # tuples support more options
-                if isinstance(tokens, tuple):
-                    for idx, token in enumerate(tokens):
-                        # hidden group
-                        if token is None:
-                            g = m.group(idx)
-                            if g:
-                                lineno += g.count('\n')
-                            continue
-                        # failure group
-                        elif token.__class__ is Failure:
-                            raise token(lineno, filename)
-                        # bygroup is a bit more complex, in that case we
-                        # yield for the current token the first named
-                        # group that matched
-                        elif token == '#bygroup':
-                            for key, value in m.groupdict().iteritems():
-                                if value is not None:
-                                    yield lineno, key, value
-                                    lineno += value.count('\n')
-                                    break
-                            else:
-                                raise RuntimeError('%r wanted to resolve '
-                                                   'the token dynamically'
-                                                   ' but no group matched'
-                                                   % regex)
-                        # normal group
-                        else:
-                            data = m.group(idx + 1)
-                            if data:
-                                yield lineno, token, data
-                            lineno += data.count('\n')
-
-                # strings as token just are yielded as it, but just
-                # if the data is not empty
-                else:
-                    data = m.group()
-                    # update brace/parentheses balance
-                    if tokens == 'operator':
-                        if data == '{':
-                            balancing_stack.append('}')
-                        elif data == '(':
-                            balancing_stack.append(')')
-                        elif data == '[':
-                            balancing_stack.append(']')
-                        elif data in ('}', ')', ']'):
-                            if not balancing_stack:
-                                raise TemplateSyntaxError('unexpected "%s"' %
-                                                          data, lineno,
-                                                          filename)
-                            expected_op = balancing_stack.pop()
-                            if expected_op != data:
-                                raise TemplateSyntaxError('unexpected "%s", '
-                                                          'expected "%s"' %
-                                                          (data, expected_op),
-                                                          lineno, filename)
-                    # yield items
-                    if tokens is not None:
-                        if data:
-                            yield lineno, tokens, data
-                    lineno += data.count('\n')
-
-                # fetch new position into new variable so that we can check
-                # if there is a internal parsing error which would result
-                # in an infinite loop
-                pos2 = m.end()
-
-                # handle state changes
-                if new_state is not None:
-                    # remove the uppermost state
-                    if new_state == '#pop':
-                        stack.pop()
-                    # resolve the new state by group checking
-                    elif new_state == '#bygroup':
-                        for key, value in m.groupdict().iteritems():
-                            if value is not None:
-                                stack.append(key)
-                                break
-                        else:
-                            raise RuntimeError('%r wanted to resolve the '
-                                               'new state dynamically but'
-                                               ' no group matched' %
-                                               regex)
-                    # direct state name given
-                    else:
-                        stack.append(new_state)
-                    statetokens = self.rules[stack[-1]]
-                # we are still at the same position and no stack change.
-                # this means a loop without break condition, avoid that and
-                # raise error
-                elif pos2 == pos:
-                    raise RuntimeError('%r yielded empty string without '
-                                       'stack change' % regex)
-                # publish new function and start again
-                pos = pos2
-                break
-            # if loop terminated without break we havn't found a single match
-            # either we are at the end of the file or we have a problem
-            else:
+            # if no rule matched we are either at the end of the file or
+            # we have a problem
+            if m is None:
                 # end of text
                 if pos >= source_length:
                     return
                 # something went wrong
                 raise TemplateSyntaxError('unexpected char %r at %d' %
-                                          (source[pos], pos), lineno,
+                                          (source[pos], pos),
+                                          bisect_left(newlines, pos) + 1,
                                           filename)
+
+            # tuples support more options
+            if tokens.__class__ is tuple:
+                for idx, token in enumerate(tokens):
+                    # hidden group
+                    if token is None:
+                        continue
+                    # failure group
+                    elif token.__class__ is Failure:
+                        raise token(bisect_left(newlines, pos) + 1, filename)
+                    # bygroup is a bit more complex, in that case we
+                    # yield for the current token the first named
+                    # group that matched
+                    elif token == '#bygroup':
+                        for key in named_groups:
+                            value = m.group(key)
+                            if value is not None:
+                                yield bisect_left(newlines, m.start(key)) \
+                                      + 1, key, value
+                                break
+                        else:
+                            raise RuntimeError('%r wanted to resolve '
+                                               'the token dynamically'
+                                               ' but no group matched'
+                                               % regex)
+                    # normal group
+                    else:
+                        data = m.group(offset + idx + 1)
+                        if data:
+                            yield bisect_left(newlines, m.start(offset +
+                                              idx + 1)) + 1, token, data
+
+            # strings as token just are yielded as it, but just
+            # if the data is not empty
+            else:
+                data = m.group(offset)
+                # update brace/parentheses balance
+                if tokens == 'operator':
+                    if data == '{':
+                        balancing_stack.append('}')
+                    elif data == '(':
+                        balancing_stack.append(')')
+                    elif data == '[':
+                        balancing_stack.append(']')
+                    elif data in ('}', ')', ']'):
+                        if not balancing_stack:
+                            raise TemplateSyntaxError('unexpected "%s"' %
+                                                      data, bisect_left(
+                                                      newlines, pos) + 1,
+                                                      filename)
+                        expected_op = balancing_stack.pop()
+                        if expected_op != data:
+                            raise TemplateSyntaxError('unexpected "%s", '
+                                                      'expected "%s"' %
+                                                      (data, expected_op),
+                                                      bisect_left(newlines,
+                                                      pos) + 1, filename)
+                # yield items
+                if tokens is not None and data:
+                    yield bisect_left(newlines, pos) + 1, tokens, data
+
+            # fetch new position into new variable so that we can check
+            # if there is a internal parsing error which would result
+            # in an infinite loop
+            pos2 = m.end()
+
+            # handle state changes
+            if new_state is not None:
+                # remove the uppermost state
+                if new_state == '#pop':
+                    stack.pop()
+                # resolve the new state by group checking
+                elif new_state == '#bygroup':
+                    for key in named_groups:
+                        if m.group(key) is not None:
+                            stack.append(key)
+                            break
+                    else:
+                        raise RuntimeError('%r wanted to resolve the '
+                                           'new state dynamically but'
+                                           ' no group matched' %
+                                           regex)
+                # direct state name given
+                else:
+                    stack.append(new_state)
+                regex, actions, balanced_regex, balanced_actions = \
+                    self.combined_rules[stack[-1]]
+            # we are still at the same position and no stack change.
+            # this means a loop without break condition, avoid that and
+            # raise error
+            elif pos2 == pos:
+                raise RuntimeError('%r yielded empty string without '
+                                   'stack change' % regex)
+            # publish new position and start again
+            pos = pos2
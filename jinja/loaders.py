@@ -9,24 +9,30 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import sys
 import codecs
 try:
     from hashlib import sha1
 except ImportError:
     from sha import new as sha1
+import os
 import time
 from os import path
-from threading import Lock
-from jinja.parser import Parser
+from threading import Lock, Event
+from weakref import WeakKeyDictionary
+from jinja.parser import Parser, get_source_hash
 from jinja.translators.python import PythonTranslator, Template
 from jinja.exceptions import TemplateNotFound, TemplateSyntaxError, \
      TemplateIncludeError
-from jinja.utils import CacheDict
+from jinja.utils import CacheDict, set
+from jinja.bundle import Bundle
+from jinja.bccache import FileSystemBytecodeCache, MemcachedBytecodeCache
+from jinja.compression import get_codec
 
 
 #: when updating this, update the listing in the jinja package too
 __all__ = ['FileSystemLoader', 'PackageLoader', 'DictLoader', 'ChoiceLoader',
-           'FunctionLoader', 'MemcachedFileSystemLoader']
+           'FunctionLoader', 'MemcachedFileSystemLoader', 'BundleLoader']
 
 
 def get_template_filename(searchpath, name):
@@ -40,13 +46,18 @@ def get_template_filename(searchpath, name):
                      if p and p[0] != '.'])
 
 
+def get_cache_key(name, salt=None):
+    """
+    Return the key of a template in the bytecode caches.
+    """
+    return sha1('jinja(%s|%s)tmpl' % (name, salt or '')).hexdigest()
+
+
 def get_cachename(cachepath, name, salt=None):
     """
     Return the filename for a cached file.
     """
-    return path.join(cachepath, 'jinja_%s.cache' %
-                     sha1('jinja(%s|%s)tmpl' %
-                          (name, salt or '')).hexdigest())
+    return path.join(cachepath, 'jinja_%s.cache' % get_cache_key(name, salt))
 
 
 def _loader_missing(*args, **kwargs):
@@ -54,6 +65,59 @@ def _loader_missing(*args, **kwargs):
     raise RuntimeError('no loader defined')
 
 
+class LoadGroup(object):
+    """
+    Coalesces concurrent loads of the same template. The first thread
+    that loads a template does the work, threads that want the same
+    template in the meantime wait for it and get the same template (or
+    exception). The number of loads saved that way is stored in the
+    `coalesced` attribute.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = Lock()
+        self._loads = {}
+
+    def load(self, name, func, *args):
+        """
+        Return the template `name` by calling `func` with `args` unless
+        another thread is already loading it.
+        """
+        self._lock.acquire()
+        try:
+            item = self._loads.get(name)
+            if item is None:
+                item = self._loads[name] = [Event(), None, None]
+                loading = True
+            else:
+                self.coalesced += 1
+                loading = False
+        finally:
+            self._lock.release()
+
+        if not loading:
+            item[0].wait()
+            if item[2] is not None:
+                raise item[2][0], item[2][1], item[2][2]
+            return item[1]
+
+        try:
+            try:
+                item[1] = func(*args)
+            except:
+                item[2] = sys.exc_info()
+                raise
+            return item[1]
+        finally:
+            self._lock.acquire()
+            try:
+                del self._loads[name]
+            finally:
+                self._lock.release()
+            item[0].set()
+
+
 class LoaderWrapper(object):
     """
     Wraps a loader so that it's bound to an environment.
@@ -129,6 +193,11 @@ class ControlledLoader(LoaderWrapper):
         LoaderWrapper.__init__(self, environment, loader)
         self._stack = []
 
+        #: the names of the templates loaded through this loader together
+        #: with the time of their last change (or `None` if the loader
+        #: doesn't provide a `check_source_changed` method).
+        self.dependencies = []
+
     def get_controlled_loader(self):
         raise TypeError('Cannot get new controlled loader from an already '
                         'controlled loader.')
@@ -139,6 +208,19 @@ class ControlledLoader(LoaderWrapper):
             raise RuntimeError('No template for marking found')
         self._stack.pop()
 
+    def add_dependency(self, name):
+        """Remember that the template `name` was loaded."""
+        name = str(name)
+        for dependency, last_change in self.dependencies:
+            if dependency == name:
+                return
+        check = getattr(self.loader, 'check_source_changed', None)
+        if check is not None:
+            last_change = check(self.environment, name)
+        else:
+            last_change = None
+        self.dependencies.append((name, last_change))
+
     def _controlled(method):
         def new_method(self, name, *args, **kw):
             if name in self._stack:
@@ -146,6 +228,7 @@ class ControlledLoader(LoaderWrapper):
                                            'detected.  %r appeared twice.' %
                                            name)
             self._stack.append(name)
+            self.add_dependency(name)
             return method(self, name, *args, **kw)
         try:
             new_method.__name__ = method.__name__
@@ -202,30 +285,140 @@ class CachedLoaderMixin(object):
     If the memcaching is enabled you can use (with Jinja 1.1 onwards)
     the `clear_memcache` function to clear the cache.
 
+    If `watch_files` is enabled (either ``True`` or a watcher from the
+    `jinja.watcher` module that can be shared by multiple loaders) and
+    the loader provides a method called `get_source_filename` that returns
+    the filename for a template name the files of the loaded templates
+    are watched for changes. Changed templates and the templates depending on
+    them are then removed from the caches instead of checking the source
+    for changes on each load.
+
+    The `cache_folder` is stored by a `FileSystemBytecodeCache` (see
+    `disk_cache`).  Its size can be limited with `cache_max_size` (in
+    bytes), `cache_max_entries` and `cache_max_age` (in seconds since the
+    last use of a cache file).
+
+    Instead of or in addition to the `cache_folder` a `bytecode_cache`
+    from the `jinja.bccache` module can store the compiled templates, for
+    example on memcached servers.  If `auto_reload` is enabled templates
+    from the caches are only used if their source didn't change.
+
     For memcached support check the `MemcachedLoaderMixin`.
     """
 
     def __init__(self, use_memcache, cache_size, cache_folder, auto_reload,
-                 cache_salt=None):
+                 cache_salt=None, reload_check_interval=0, watch_files=False,
+                 compress_cache=False, compress_threshold=1024,
+                 bytecode_cache=None, cache_max_size=None,
+                 cache_max_entries=None, cache_max_age=None):
         if use_memcache:
             self.__memcache = CacheDict(cache_size)
         else:
             self.__memcache = None
         self.__cache_folder = cache_folder
+        if cache_folder is not None:
+            self.__disk_cache = FileSystemBytecodeCache(cache_folder,
+                max_size=cache_max_size, max_entries=cache_max_entries,
+                max_age=cache_max_age)
+        else:
+            self.__disk_cache = None
+        self.__bytecode_cache = bytecode_cache
         if not hasattr(self, 'check_source_changed'):
             self.__auto_reload = False
         else:
             self.__auto_reload = auto_reload
         self.__salt = cache_salt
-        self.__times = {}
+        self.__codec = get_codec(compress_cache)
+        self.__compress_threshold = compress_threshold
+        self.__check_interval = reload_check_interval
+        self.__checks = {}
         self.__lock = Lock()
+        self.__loads = LoadGroup()
+        self.__dependents = {}
+        self.__invalidation_count = 0
+        self.__invalidations = {}
+        self.__watched = set()
+        self.__cache_loads = WeakKeyDictionary()
+        if not watch_files or not hasattr(self, 'get_source_filename'):
+            self.__watcher = None
+        elif watch_files is True:
+            from jinja.watcher import get_watcher
+            self.__watcher = get_watcher()
+        else:
+            self.__watcher = watch_files
+
+    coalesced_loads = property(lambda s: s.__loads.coalesced, doc="""
+        The number of loads that waited for another thread loading the
+        same template instead of compiling it again.""")
+
+    cache_folder = property(lambda s: s.__cache_folder, doc="""
+        The folder of the disk cache or `None`.""")
+
+    disk_cache = property(lambda s: s.__disk_cache, doc="""
+        The `FileSystemBytecodeCache` storing the `cache_folder` or
+        `None`.""")
+
+    bytecode_cache = property(lambda s: s.__bytecode_cache, doc="""
+        The bytecode cache or `None`.""")
+
+    watcher = property(lambda s: s.__watcher, doc="""
+        The watcher that reports changed templates or `None`.""")
+
+    def unrendered_templates(self):
+        """
+        The number of templates loaded from the disk cache or the bytecode
+        cache that are still in memory but were never rendered.  *New in
+        Jinja 1.3*
+        """
+        self.__lock.acquire()
+        try:
+            templates = self.__cache_loads.keys()
+        finally:
+            self.__lock.release()
+        return len([x for x in templates if x.generate_func is None])
+    unrendered_templates = property(unrendered_templates)
 
     def clear_memcache(self):
         """
         Clears the memcache.
         """
         if self.__memcache is not None:
-            self.__memcache.clear()
+            self.__lock.acquire()
+            try:
+                self.__memcache.clear()
+                self.__checks.clear()
+            finally:
+                self.__lock.release()
+
+    def prune(self):
+        """
+        Remove the files exceeding the limits of the cache folder.  Returns
+        the number of removed files.  *New in Jinja 1.3*
+        """
+        if self.__disk_cache is None:
+            return 0
+        return self.__disk_cache.prune()
+
+    def invalidate(self, name):
+        """
+        Remove a template and all the templates that extend or include
+        it from the memory cache, the disk cache and the bytecode cache.
+        """
+        self.__lock.acquire()
+        try:
+            names = set([name]) | self.__dependents.pop(name, set())
+            self.__invalidation_count += 1
+            for name in names:
+                if self.__memcache is not None and name in self.__memcache:
+                    del self.__memcache[name]
+                self.__checks.pop(name, None)
+                self.__invalidations[name] = self.__invalidation_count
+        finally:
+            self.__lock.release()
+        for cache in self.__disk_cache, self.__bytecode_cache:
+            if cache is not None:
+                for name in names:
+                    cache.remove_bytecode(get_cache_key(name, self.__salt))
 
     def load(self, environment, name, translator):
         """
@@ -234,83 +427,207 @@ class CachedLoaderMixin(object):
         not the cache check for a compiled template in the disk cache
         folder. And if none of this is the case we translate the temlate,
         cache and return it.
+
+        Templates in the memory cache are returned without locking. If
+        multiple threads load the same template only one of them loads
+        it, the others wait for it (see `coalesced_loads`).
         """
-        self.__lock.acquire()
-        try:
-            # caching is only possible for the python translator. skip
-            # all other translators
-            if not issubclass(translator, PythonTranslator):
-                return super(CachedLoaderMixin, self).load(
-                             environment, name, translator)
+        # caching is only possible for the python translator. skip
+        # all other translators
+        if not issubclass(translator, PythonTranslator):
+            return super(CachedLoaderMixin, self).load(
+                         environment, name, translator)
+
+        # auto reload enabled? check for the last change of
+        # the template unless the watcher tells us about changes
+        if self.__auto_reload and self.__watcher is None:
+            last_change = self.__check_source_changed(environment, name)
+        else:
+            last_change = None
+
+        # check the memory cache first.  if the template is there we
+        # move it up in the cache but only if no other thread is
+        # holding the lock right now.
+        tmpl = self.__get_from_memcache(environment, name, last_change)
+        if tmpl is not None:
+            if self.__lock.acquire(False):
+                try:
+                    if name in self.__memcache:
+                        self.__memcache[name]
+                finally:
+                    self.__lock.release()
+            return tmpl
 
-            tmpl = None
-            save_to_disk = False
-            push_to_memory = False
+        return self.__loads.load(name, self.__load, environment, name,
+                                 translator, last_change)
 
-            # auto reload enabled? check for the last change of
-            # the template
-            if self.__auto_reload:
-                last_change = self.check_source_changed(environment, name)
-            else:
-                last_change = None
-
-            # check if we have something in the memory cache and the
-            # memory cache is enabled.
-            if self.__memcache is not None:
-                if name in self.__memcache:
-                    tmpl = self.__memcache[name]
-                    # if auto reload is enabled check if the template changed
-                    if last_change and last_change > self.__times[name]:
-                        tmpl = None
-                        push_to_memory = True
-                else:
-                    push_to_memory = True
+    def __load(self, environment, name, translator, last_change):
+        """
+        Load a template that is not in the memory cache.
+        """
+        # another thread could have loaded the template since we
+        # checked the memory cache
+        tmpl = self.__get_from_memcache(environment, name, last_change)
+        if tmpl is not None:
+            return tmpl
 
-            # mem cache disabled or not cached by now
-            # try to load if from the disk cache
-            if tmpl is None and self.__cache_folder is not None:
-                cache_fn = get_cachename(self.__cache_folder, name, self.__salt)
-                if last_change is not None:
-                    try:
-                        cache_time = path.getmtime(cache_fn)
-                    except OSError:
-                        cache_time = 0
-                if last_change is None or (cache_time and
-                   last_change <= cache_time):
-                    try:
-                        f = file(cache_fn, 'rb')
-                    except IOError:
-                        tmpl = None
-                        save_to_disk = True
-                    else:
-                        try:
-                            tmpl = Template.load(environment, f)
-                        finally:
-                            f.close()
-                else:
-                    save_to_disk = True
+        # templates invalidated while we load them must not be cached,
+        # we could have loaded the old source.
+        load_count = self.__invalidation_count
+
+        # if a watcher is used we start watching the template before
+        # loading it and check the source like for the polling case,
+        # the disk cache could be older than the source.
+        if self.__watcher is not None:
+            self.__watch(environment, name)
+            if self.__auto_reload:
+                last_change = self.__check_source_changed(environment, name)
+
+        # mem cache disabled or not cached by now
+        # try to load it from the disk cache and then from the bytecode
+        # cache.  if it's not there another process sharing the cache
+        # could be compiling it right now, so we lock the template in
+        # the caches that support it and check again.
+        cache_key = get_cache_key(name, self.__salt)
+        tmpl, missed = self.__load_from_caches(environment, name, cache_key)
+        locked = []
+        try:
+            if tmpl is None:
+                locked = [x for x in missed if x.acquire(cache_key)]
+                if locked:
+                    tmpl, missed = self.__load_from_caches(environment, name,
+                                                           cache_key)
 
             # if we still have no template we load, parse and translate it.
             if tmpl is None:
                 tmpl = super(CachedLoaderMixin, self).load(
                              environment, name, translator)
 
-            # save the compiled template on the disk if enabled
-            if save_to_disk:
-                f = file(cache_fn, 'wb')
-                try:
-                    tmpl.dump(f)
-                finally:
-                    f.close()
+            # save the compiled template in the caches that don't have it
+            if missed and not self.__invalidated_since(tmpl, name,
+                                                       load_count):
+                bytecode = tmpl.dump(None, self.__codec,
+                                     self.__compress_threshold)
+                for cache in missed:
+                    cache.dump_bytecode(cache_key, bytecode)
+        finally:
+            for cache in locked:
+                cache.release(cache_key)
 
-            # if memcaching is enabled and the template not loaded
-            # we add that there.
-            if push_to_memory:
-                self.__times[name] = time.time()
-                self.__memcache[name] = tmpl
-            return tmpl
+        # remember the templates that depend on other templates so
+        # that we can remove them from the cache if the other templates
+        # change.
+        self.__lock.acquire()
+        try:
+            for dependency, dependency_change in tmpl.dependencies:
+                self.__dependents.setdefault(dependency, set()).add(name)
         finally:
             self.__lock.release()
+        if self.__watcher is not None:
+            for dependency, dependency_change in tmpl.dependencies:
+                self.__watch(environment, dependency)
+
+        # if memcaching is enabled we add the template there
+        # together with the time it was loaded.
+        if self.__memcache is not None:
+            self.__lock.acquire()
+            try:
+                if not self.__invalidated_since(tmpl, name, load_count):
+                    self.__memcache[name] = (tmpl, time.time())
+            finally:
+                self.__lock.release()
+        return tmpl
+
+    def __invalidated_since(self, tmpl, name, count):
+        """
+        Check if `invalidate` was called for the template `name` or one
+        of the templates compiled into `tmpl` after the invalidation
+        counter was `count`.
+        """
+        for name in [name] + [x[0] for x in tmpl.dependencies]:
+            if self.__invalidations.get(name, 0) > count:
+                return True
+        return False
+
+    def __load_from_caches(self, environment, name, cache_key):
+        """
+        Load a template from the disk cache or the bytecode cache.  Returns
+        the template (or `None`) and the caches checked without finding it.
+        If auto reload is enabled cached templates are only used if the
+        template and its dependencies didn't change.
+        """
+        missed = []
+        for cache in self.__disk_cache, self.__bytecode_cache:
+            if cache is None:
+                continue
+            tmpl = cache.load_template(environment, cache_key)
+            if tmpl is not None and self.__auto_reload and \
+               (tmpl.source_hash is None or tmpl.source_hash !=
+                get_source_hash(environment, self.get_source(environment,
+                                                             name, None)) or
+                self.__dependencies_changed(environment, tmpl)):
+                tmpl = None
+            if tmpl is not None:
+                self.__lock.acquire()
+                try:
+                    self.__cache_loads[tmpl] = True
+                finally:
+                    self.__lock.release()
+                return tmpl, missed
+            missed.append(cache)
+        return None, missed
+
+    def __watch(self, environment, name):
+        """
+        Tell the watcher to invalidate the template if its file changes.
+        """
+        if name not in self.__watched:
+            self.__watched.add(name)
+            self.__watcher.watch(self.get_source_filename(environment, name),
+                                 lambda: self.invalidate(name))
+
+    def __check_source_changed(self, environment, name):
+        """
+        Call `check_source_changed` unless the template was checked in
+        the last `reload_check_interval` seconds. In that case the result
+        of that check is returned.
+        """
+        if not self.__check_interval:
+            return self.check_source_changed(environment, name)
+        now = time.time()
+        item = self.__checks.get(name)
+        if item is not None and now - item[0] < self.__check_interval:
+            return item[1]
+        last_change = self.check_source_changed(environment, name)
+        self.__checks[name] = (now, last_change)
+        return last_change
+
+    def __get_from_memcache(self, environment, name, last_change):
+        """
+        Return the template from the memory cache or `None` if it's not
+        cached or it or one of its dependencies changed since it was
+        cached. This does not lock.
+        """
+        if self.__memcache is not None:
+            item = self.__memcache.peek(name)
+            if item is not None:
+                tmpl, load_time = item
+                if (not last_change or last_change <= load_time) and \
+                   (self.__watcher is not None or
+                    not self.__dependencies_changed(environment, tmpl)):
+                    return tmpl
+
+    def __dependencies_changed(self, environment, tmpl):
+        """
+        If auto reload is enabled check if one of the templates compiled
+        into `tmpl` changed since it was compiled.
+        """
+        if self.__auto_reload:
+            for name, last_change in tmpl.dependencies:
+                if last_change is not None and last_change != \
+                   self.__check_source_changed(environment, name):
+                    return True
+        return False
 
 
 class MemcachedLoaderMixin(object):
@@ -324,12 +641,24 @@ class MemcachedLoaderMixin(object):
     that takes an already instanciated memcache client or memcache client
     like object.
 
+    Since Jinja 1.3 the last `local_cache_size` templates loaded can also
+    be kept in the process so that they are not fetched from the server on
+    every load, and `preload` loads many templates with one request to the
+    server.  Templates in the local cache are used until they are removed
+    by `clear_local_cache`, even if they were replaced on the server, so
+    the local cache is disabled by default.
+
+    The templates are stored on the server by a `MemcachedBytecodeCache`
+    (see `bytecode_cache`) with the template names as keys.
+
     .. _tummy: http://www.tummy.com/Community/software/python-memcached/
     .. _Gisjsbert de Haan: http://gijsbert.org/cmemcache/
     """
 
     def __init__(self, use_memcache, memcache_time=60 * 60 * 24 * 7,
-                 memcache_host=None, item_prefix='template/', client=None):
+                 memcache_host=None, item_prefix='template/', client=None,
+                 compress_cache=False, compress_threshold=1024,
+                 local_cache_size=0):
         if memcache_host is None:
             memcache_host = ['127.0.0.1:11211']
         if use_memcache:
@@ -344,53 +673,144 @@ class MemcachedLoaderMixin(object):
                                        'memcache module' %
                                        self.__class__.__name__)
                 client = Client(list(memcache_host))
-            self.__memcache = client
-            self.__memcache_time = memcache_time
+            self.__bytecode_cache = MemcachedBytecodeCache(client,
+                                                           item_prefix,
+                                                           memcache_time)
         else:
-            self.__memcache = None
-        self.__item_prefix = item_prefix
-        self.__lock = Lock()
+            self.__bytecode_cache = None
+        if use_memcache and local_cache_size:
+            self.__local_cache = CacheDict(local_cache_size)
+        else:
+            self.__local_cache = None
+        self.__codec = get_codec(compress_cache)
+        self.__compress_threshold = compress_threshold
+        self.__local_lock = Lock()
+        self.__loads = LoadGroup()
+
+    coalesced_loads = property(lambda s: s.__loads.coalesced, doc="""
+        The number of loads that waited for another thread loading the
+        same template instead of compiling it again.""")
+
+    bytecode_cache = property(lambda s: s.__bytecode_cache, doc="""
+        The `MemcachedBytecodeCache` storing the templates or `None`.""")
+
+    def clear_local_cache(self):
+        """
+        Clear the templates cached in the process.
+        """
+        if self.__local_cache is not None:
+            self.__local_lock.acquire()
+            try:
+                self.__local_cache.clear()
+            finally:
+                self.__local_lock.release()
 
     def load(self, environment, name, translator):
         """
         Load and translate a template. First we check if there is a
-        cached version of this template in the memory cache. If this is
-        not the cache check for a compiled template in the disk cache
-        folder. And if none of this is the case we translate the template,
-        cache and return it.
+        cached version of this template in the local cache, then on the
+        memcached server.  If none of this is the case we translate the
+        template, cache and return it.
+
+        If multiple threads load the same template only one of them loads
+        it, the others wait for it (see `coalesced_loads`).
         """
-        self.__lock.acquire()
-        try:
-            # caching is only possible for the python translator. skip
-            # all other translators
-            if not issubclass(translator, PythonTranslator):
-                return super(MemcachedLoaderMixin, self).load(
-                             environment, name, translator)
-            tmpl = None
-            push_to_memory = False
-
-            # check if we have something in the memory cache and the
-            # memory cache is enabled.
-            if self.__memcache is not None:
-                bytecode = self.__memcache.get(self.__item_prefix + name)
-                if bytecode:
-                    tmpl = Template.load(environment, bytecode)
-                else:
-                    push_to_memory = True
+        # caching is only possible for the python translator. skip
+        # all other translators
+        if not issubclass(translator, PythonTranslator):
+            return super(MemcachedLoaderMixin, self).load(
+                         environment, name, translator)
+        if self.__local_cache is not None:
+            tmpl = self.__local_cache.peek(name)
+            if tmpl is not None:
+                if self.__local_lock.acquire(False):
+                    try:
+                        if name in self.__local_cache:
+                            self.__local_cache[name]
+                    finally:
+                        self.__local_lock.release()
+                return tmpl
+        return self.__loads.load(name, self.__load, environment, name,
+                                 translator)
 
-            # if we still have no template we load, parse and translate it.
+    def preload(self, environment, names):
+        """
+        Load the templates `names` into the local cache with one request
+        to the memcached server.  Templates missing on the server are
+        compiled and stored on the server with another request.  Clients
+        without `get_multi` and `set_multi` methods get one request per
+        template.  Returns the names of the templates that don't exist or
+        have syntax errors.
+        """
+        if self.__bytecode_cache is None:
+            return []
+        names = [str(name) for name in names]
+        found = self.__bytecode_cache.load_many(names)
+
+        missing = {}
+        failed = []
+        for name in names:
+            tmpl = None
+            if name in found:
+                try:
+                    tmpl = Template.load(environment, found[name])
+                except (ValueError, EOFError):
+                    pass
             if tmpl is None:
-                tmpl = super(MemcachedLoaderMixin, self).load(
-                             environment, name, translator)
+                try:
+                    tmpl = super(MemcachedLoaderMixin, self).load(
+                                 environment, name, PythonTranslator)
+                except (TemplateNotFound, TemplateSyntaxError):
+                    failed.append(name)
+                    continue
+                missing[name] = tmpl.dump(None, self.__codec,
+                                          self.__compress_threshold)
+            self.__cache_locally(name, tmpl)
+
+        if missing:
+            self.__bytecode_cache.dump_many(missing)
+        return failed
+
+    def __cache_locally(self, name, tmpl):
+        """Add a template to the local cache if enabled."""
+        if self.__local_cache is not None:
+            self.__local_lock.acquire()
+            try:
+                self.__local_cache[name] = tmpl
+            finally:
+                self.__local_lock.release()
 
-            # if memcaching is enabled and the template not loaded
-            # we add that there.
-            if push_to_memory:
-                self.__memcache.set(self.__item_prefix + name, tmpl.dump(),
-                                    self.__memcache_time)
-            return tmpl
-        finally:
-            self.__lock.release()
+    def __load(self, environment, name, translator):
+        """
+        Load a template through the memcache client.
+        """
+        # another thread could have loaded the template since we
+        # checked the local cache
+        if self.__local_cache is not None:
+            tmpl = self.__local_cache.peek(name)
+            if tmpl is not None:
+                return tmpl
+        tmpl = None
+        push_to_memory = False
+
+        # check if we have something in the memory cache and the
+        # memory cache is enabled.
+        if self.__bytecode_cache is not None:
+            tmpl = self.__bytecode_cache.load_template(environment, name)
+            push_to_memory = tmpl is None
+
+        # if we still have no template we load, parse and translate it.
+        if tmpl is None:
+            tmpl = super(MemcachedLoaderMixin, self).load(
+                         environment, name, translator)
+
+        # if memcaching is enabled and the template not loaded
+        # we add that there.
+        if push_to_memory:
+            self.__bytecode_cache.dump_bytecode(name, tmpl.dump(None,
+                self.__codec, self.__compress_threshold))
+        self.__cache_locally(name, tmpl)
+        return tmpl
 
 
 class BaseFileSystemLoader(BaseLoader):
@@ -408,17 +828,94 @@ class BaseFileSystemLoader(BaseLoader):
             def __init__(self):
                 BaseFileSystemLoader.__init__(self, '/path/to/templates')
 
-    The base file system loader only takes one parameter beside self which
-    is the path to the templates.
+    The base file system loader takes the path to the templates and, with
+    Jinja 1.3 onwards, a flag that enables the index.  In index mode the
+    searchpath is walked once and the filenames and modification times of
+    all the templates are kept in memory so that looking up a template
+    doesn't touch the file system.  The index is not updated automatically,
+    call `refresh_index` after adding, changing or removing templates.
     """
 
-    def __init__(self, searchpath):
+    def __init__(self, searchpath, use_index=False):
         self.searchpath = path.abspath(searchpath)
+        self._index = None
+        if use_index:
+            self.refresh_index()
+
+    def _walk(self):
+        """
+        Yield the filenames of all the templates in the searchpath.  Hidden
+        files and folders are skipped because they can't be loaded.  Linked
+        folders are followed like by the lookup of a template, links to a
+        folder containing the link are not.
+        """
+        stack = [(self.searchpath, ())]
+        while stack:
+            dirpath, parents = stack.pop()
+            realpath = path.realpath(dirpath)
+            if realpath in parents:
+                continue
+            parents += (realpath,)
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                continue
+            for name in names:
+                if name[:1] == '.':
+                    continue
+                filename = path.join(dirpath, name)
+                if path.isdir(filename):
+                    stack.append((filename, parents))
+                else:
+                    yield filename
+
+    def refresh_index(self, name=None):
+        """
+        Rebuild the index or, if a template name is given, update the
+        entry of that template.  Does nothing if the index is disabled
+        and a name is given.  *New in Jinja 1.3*
+        """
+        if name is None:
+            index = {}
+            for filename in self._walk():
+                try:
+                    index[filename] = path.getmtime(filename)
+                except OSError:
+                    pass
+            self._index = index
+        elif self._index is not None:
+            filename = get_template_filename(self.searchpath, name)
+            try:
+                self._index[filename] = path.getmtime(filename)
+            except OSError:
+                self._index.pop(filename, None)
+
+    def list_templates(self):
+        """
+        Return a sorted list of the names of all the templates.  *New in
+        Jinja 1.3*
+        """
+        if self._index is not None:
+            filenames = self._index.keys()
+        else:
+            filenames = self._walk()
+        offset = len(path.join(self.searchpath, ''))
+        rv = [filename[offset:].replace(path.sep, '/')
+              for filename in filenames]
+        rv.sort()
+        return rv
 
     def get_source(self, environment, name, parent):
         filename = get_template_filename(self.searchpath, name)
-        if path.isfile(filename):
-            f = codecs.open(filename, 'r', environment.template_charset)
+        if self._index is not None:
+            exists = filename in self._index
+        else:
+            exists = path.isfile(filename)
+        if exists:
+            try:
+                f = codecs.open(filename, 'r', environment.template_charset)
+            except IOError:
+                raise TemplateNotFound(name)
             try:
                 return f.read()
             finally:
@@ -439,47 +936,94 @@ class FileSystemLoader(CachedLoaderMixin, BaseFileSystemLoader):
     You can pass the following keyword arguments to the loader on
     initialization:
 
-    =================== =================================================
-    ``searchpath``      String with the path to the templates on the
-                        filesystem.
-    ``use_memcache``    Set this to ``True`` to enable memory caching.
-                        This is usually a good idea in production mode,
-                        but disable it during development since it won't
-                        reload template changes automatically.
-                        This only works in persistent environments like
-                        FastCGI.
-    ``memcache_size``   Number of template instance you want to cache.
-                        Defaults to ``40``.
-    ``cache_folder``    Set this to an existing directory to enable
-                        caching of templates on the file system. Note
-                        that this only affects templates transformed
-                        into python code. Default is ``None`` which means
-                        that caching is disabled.
-    ``auto_reload``     Set this to `False` for a slightly better
-                        performance. In that case Jinja won't check for
-                        template changes on the filesystem.
-    ``cache_salt``      Optional unique number to not confuse the
-                        caching system when caching more than one
-                        template loader in the same folder. Defaults
-                        to the searchpath. *New in Jinja 1.1*
-    =================== =================================================
+    ========================= =================================================
+    ``searchpath``            String with the path to the templates on the
+                              filesystem.
+    ``use_memcache``          Set this to ``True`` to enable memory caching.
+                              This is usually a good idea in production mode,
+                              but disable it during development since it won't
+                              reload template changes automatically. This only
+                              works in persistent environments like FastCGI.
+    ``memcache_size``         Number of template instance you want to cache.
+                              Defaults to ``40``.
+    ``cache_folder``          Set this to an existing directory to enable
+                              caching of templates on the file system. Note
+                              that this only affects templates transformed into
+                              python code. Default is ``None`` which means that
+                              caching is disabled.
+    ``auto_reload``           Set this to `False` for a slightly better
+                              performance. In that case Jinja won't check for
+                              template changes on the filesystem.
+    ``cache_salt``            Optional unique number to not confuse the caching
+                              system when caching more than one template loader
+                              in the same folder. Defaults to the searchpath.
+                              *New in Jinja 1.1*
+    ``reload_check_interval`` If `auto_reload` is enabled the source of a
+                              template is checked for changes at most once in
+                              this number of seconds. Defaults to ``0`` which
+                              means on every load. *New in Jinja 1.3*
+    ``watch_files``           If this is ``True`` and `auto_reload` is enabled
+                              the template files are watched for changes (with
+                              inotify on Linux or a polling thread otherwise)
+                              instead of checking them on each load. Can also
+                              be a watcher from `jinja.watcher` shared with
+                              other loaders. *New in Jinja 1.3*
+    ``compress_cache``        Set this to ``True`` to compress the templates
+                              in the disk cache with zlib or to a codec from
+                              `jinja.compression`. *New in Jinja 1.3*
+    ``compress_threshold``    Templates smaller than this number of bytes are
+                              not compressed. Defaults to ``1024``.
+    ``bytecode_cache``        A bytecode cache from `jinja.bccache` that
+                              stores the compiled templates in addition to
+                              the `cache_folder`. *New in Jinja 1.3*
+    ``cache_max_size``        The maximum size of the files in the
+                              `cache_folder` in bytes. The least recently
+                              used files are removed in the background if
+                              the folder gets bigger. *New in Jinja 1.3*
+    ``cache_max_entries``     The maximum number of files in the
+                              `cache_folder`. *New in Jinja 1.3*
+    ``cache_max_age``         Cache files not used for this number of
+                              seconds are removed. *New in Jinja 1.3*
+    ``use_index``             If this is ``True`` the searchpath is walked once
+                              and the templates are looked up in memory. See
+                              `refresh_index`. *New in Jinja 1.3*
+    ========================= =================================================
     """
 
     def __init__(self, searchpath, use_memcache=False, memcache_size=40,
-                 cache_folder=None, auto_reload=True, cache_salt=None):
-        BaseFileSystemLoader.__init__(self, searchpath)
+                 cache_folder=None, auto_reload=True, cache_salt=None,
+                 reload_check_interval=0, watch_files=False,
+                 compress_cache=False, compress_threshold=1024,
+                 bytecode_cache=None, cache_max_size=None,
+                 cache_max_entries=None, cache_max_age=None,
+                 use_index=False):
+        BaseFileSystemLoader.__init__(self, searchpath, use_index)
 
         if cache_salt is None:
             cache_salt = self.searchpath
         CachedLoaderMixin.__init__(self, use_memcache, memcache_size,
-                                   cache_folder, auto_reload, cache_salt)
+                                   cache_folder, auto_reload, cache_salt,
+                                   reload_check_interval,
+                                   auto_reload and watch_files or False,
+                                   compress_cache, compress_threshold,
+                                   bytecode_cache, cache_max_size,
+                                   cache_max_entries, cache_max_age)
+
+    def get_source_filename(self, environment, name):
+        return get_template_filename(self.searchpath, name)
 
     def check_source_changed(self, environment, name):
-        filename = get_template_filename(self.searchpath, name)
+        filename = self.get_source_filename(environment, name)
+        if self._index is not None:
+            return self._index.get(filename, -1)
         if path.isfile(filename):
             return path.getmtime(filename)
         return -1
 
+    def invalidate(self, name):
+        self.refresh_index(name)
+        CachedLoaderMixin.invalidate(self, name)
+
 
 class MemcachedFileSystemLoader(MemcachedLoaderMixin, BaseFileSystemLoader):
     """
@@ -496,25 +1040,38 @@ class MemcachedFileSystemLoader(MemcachedLoaderMixin, BaseFileSystemLoader):
     You can pass the following keyword arguments to the loader on
     initialization:
 
-    =================== =================================================
-    ``searchpath``      String with the path to the templates on the
-                        filesystem.
-    ``use_memcache``    Set this to ``True`` to enable memcached caching.
-                        In that case it behaves like a normal
-                        `FileSystemLoader` with disabled caching.
-    ``memcache_time``   The expire time of a template in the cache.
-    ``memcache_host``   a list of memcached servers.
-    ``item_prefix``     The prefix for the items on the server. Defaults
-                        to ``'template/'``.
-    =================== =================================================
+    ========================= =================================================
+    ``searchpath``            String with the path to the templates on the
+                              filesystem.
+    ``use_memcache``          Set this to ``True`` to enable memcached caching.
+                              In that case it behaves like a normal
+                              `FileSystemLoader` with disabled caching.
+    ``memcache_time``         The expire time of a template in the cache.
+    ``memcache_host``         a list of memcached servers.
+    ``item_prefix``           The prefix for the items on the server. Defaults
+                              to ``'template/'``.
+    ``compress_cache``        Set this to ``True`` to compress the templates
+                              on the server with zlib or to a codec from
+                              `jinja.compression`. *New in Jinja 1.3*
+    ``compress_threshold``    Templates smaller than this number of bytes are
+                              not compressed. Defaults to ``1024``.
+    ``local_cache_size``      Number of templates also cached in the process.
+                              Defaults to ``0`` which disables the local
+                              cache. Templates in the local cache are not
+                              reloaded if they change on the server, see
+                              `clear_local_cache`. *New in Jinja 1.3*
+    ========================= =================================================
     """
 
     def __init__(self, searchpath, use_memcache=True,
                  memcache_time=60 * 60 * 24 * 7, memcache_host=None,
-                 item_prefix='template/'):
+                 item_prefix='template/', compress_cache=False,
+                 compress_threshold=1024, local_cache_size=0):
         BaseFileSystemLoader.__init__(self, searchpath)
         MemcachedLoaderMixin.__init__(self, use_memcache, memcache_time,
-                                      memcache_host, item_prefix)
+                                      memcache_host, item_prefix, None,
+                                      compress_cache, compress_threshold,
+                                      local_cache_size)
 
 
 class BasePackageLoader(BaseLoader):
@@ -600,33 +1157,58 @@ class PackageLoader(CachedLoaderMixin, BasePackageLoader):
     You can pass the following keyword arguments to the loader on
     initialization:
 
-    =================== =================================================
-    ``package_name``    Name of the package containing the templates.
-    ``package_path``    Path of the templates inside the package.
-    ``use_memcache``    Set this to ``True`` to enable memory caching.
-                        This is usually a good idea in production mode,
-                        but disable it during development since it won't
-                        reload template changes automatically.
-                        This only works in persistent environments like
-                        FastCGI.
-    ``memcache_size``   Number of template instance you want to cache.
-                        Defaults to ``40``.
-    ``cache_folder``    Set this to an existing directory to enable
-                        caching of templates on the file system. Note
-                        that this only affects templates transformed
-                        into python code. Default is ``None`` which means
-                        that caching is disabled.
-    ``auto_reload``     Set this to `False` for a slightly better
-                        performance. In that case Jinja won't check for
-                        template changes on the filesystem. If the
-                        templates are inside of an egg file this won't
-                        have an effect.
-    ``cache_salt``      Optional unique number to not confuse the
-                        caching system when caching more than one
-                        template loader in the same folder. Defaults
-                        to ``package_name + '/' + package_path``.
-                        *New in Jinja 1.1*
-    =================== =================================================
+    ========================= =================================================
+    ``package_name``          Name of the package containing the templates.
+    ``package_path``          Path of the templates inside the package.
+    ``use_memcache``          Set this to ``True`` to enable memory caching.
+                              This is usually a good idea in production mode,
+                              but disable it during development since it won't
+                              reload template changes automatically. This only
+                              works in persistent environments like FastCGI.
+    ``memcache_size``         Number of template instance you want to cache.
+                              Defaults to ``40``.
+    ``cache_folder``          Set this to an existing directory to enable
+                              caching of templates on the file system. Note
+                              that this only affects templates transformed into
+                              python code. Default is ``None`` which means that
+                              caching is disabled.
+    ``auto_reload``           Set this to `False` for a slightly better
+                              performance. In that case Jinja won't check for
+                              template changes on the filesystem. If the
+                              templates are inside of an egg file this won't
+                              have an effect.
+    ``cache_salt``            Optional unique number to not confuse the caching
+                              system when caching more than one template loader
+                              in the same folder. Defaults to
+                              ``package_name + '/' + package_path``.
+                              *New in Jinja 1.1*
+    ``reload_check_interval`` If `auto_reload` is enabled the source of a
+                              template is checked for changes at most once in
+                              this number of seconds. Defaults to ``0`` which
+                              means on every load. *New in Jinja 1.3*
+    ``watch_files``           If this is ``True`` and `auto_reload` is enabled
+                              the template files are watched for changes (with
+                              inotify on Linux or a polling thread otherwise)
+                              instead of checking them on each load. Can also
+                              be a watcher from `jinja.watcher` shared with
+                              other loaders. *New in Jinja 1.3*
+    ``compress_cache``        Set this to ``True`` to compress the templates
+                              in the disk cache with zlib or to a codec from
+                              `jinja.compression`. *New in Jinja 1.3*
+    ``compress_threshold``    Templates smaller than this number of bytes are
+                              not compressed. Defaults to ``1024``.
+    ``bytecode_cache``        A bytecode cache from `jinja.bccache` that
+                              stores the compiled templates in addition to
+                              the `cache_folder`. *New in Jinja 1.3*
+    ``cache_max_size``        The maximum size of the files in the
+                              `cache_folder` in bytes. The least recently
+                              used files are removed in the background if
+                              the folder gets bigger. *New in Jinja 1.3*
+    ``cache_max_entries``     The maximum number of files in the
+                              `cache_folder`. *New in Jinja 1.3*
+    ``cache_max_age``         Cache files not used for this number of
+                              seconds are removed. *New in Jinja 1.3*
+    ========================= =================================================
 
     Important note: If you're using an application that is inside of an
     egg never set `auto_reload` to `True`. The egg resource manager will
@@ -637,18 +1219,32 @@ class PackageLoader(CachedLoaderMixin, BasePackageLoader):
 
     def __init__(self, package_name, package_path, use_memcache=False,
                  memcache_size=40, cache_folder=None, auto_reload=True,
-                 cache_salt=None):
+                 cache_salt=None, reload_check_interval=0,
+                 watch_files=False, compress_cache=False,
+                 compress_threshold=1024, bytecode_cache=None,
+                 cache_max_size=None, cache_max_entries=None,
+                 cache_max_age=None):
         BasePackageLoader.__init__(self, package_name, package_path)
 
         if cache_salt is None:
             cache_salt = package_name + '/' + package_path
         CachedLoaderMixin.__init__(self, use_memcache, memcache_size,
-                                   cache_folder, auto_reload, cache_salt)
+                                   cache_folder, auto_reload, cache_salt,
+                                   reload_check_interval,
+                                   auto_reload and watch_files or False,
+                                   compress_cache, compress_threshold,
+                                   bytecode_cache, cache_max_size,
+                                   cache_max_entries, cache_max_age)
+
+    def get_source_filename(self, environment, name):
+        from pkg_resources import resource_filename
+        return resource_filename(self.package_name, '/'.join(
+            [self.package_path] + [p for p in name.split('/')
+                                   if p and p[0] != '.']))
 
     def check_source_changed(self, environment, name):
-        from pkg_resources import resource_exists, resource_filename
-        fn = resource_filename(self.package_name, '/'.join([self.package_path] +
-                               [p for p in name.split('/') if p and p[0] != '.']))
+        from pkg_resources import resource_exists
+        fn = self.get_source_filename(environment, name)
         if resource_exists(self.package_name, fn):
             return path.getmtime(fn)
         return -1
@@ -707,40 +1303,63 @@ class FunctionLoader(CachedLoaderMixin, BaseFunctionLoader):
     You can pass the following keyword arguments to the loader on
     initialization:
 
-    =================== =================================================
-    ``loader_func``     Function that takes the name of the template to
-                        load. If it returns a string or unicode object
-                        it's used to load a template. If the return
-                        value is None it's considered missing.
-    ``getmtime_func``   Function used to check if templates requires
-                        reloading. Has to return the UNIX timestamp of
-                        the last template change or ``-1`` if this template
-                        does not exist or requires updates at any cost.
-    ``use_memcache``    Set this to ``True`` to enable memory caching.
-                        This is usually a good idea in production mode,
-                        but disable it during development since it won't
-                        reload template changes automatically.
-                        This only works in persistent environments like
-                        FastCGI.
-    ``memcache_size``   Number of template instance you want to cache.
-                        Defaults to ``40``.
-    ``cache_folder``    Set this to an existing directory to enable
-                        caching of templates on the file system. Note
-                        that this only affects templates transformed
-                        into python code. Default is ``None`` which means
-                        that caching is disabled.
-    ``auto_reload``     Set this to `False` for a slightly better
-                        performance. In that case of `getmtime_func`
-                        not being provided this won't have an effect.
-    ``cache_salt``      Optional unique number to not confuse the
-                        caching system when caching more than one
-                        template loader in the same folder.
-    =================== =================================================
+    ========================= =================================================
+    ``loader_func``           Function that takes the name of the template to
+                              load. If it returns a string or unicode object
+                              it's used to load a template. If the return value
+                              is None it's considered missing.
+    ``getmtime_func``         Function used to check if templates requires
+                              reloading. Has to return the UNIX timestamp of
+                              the last template change or ``-1`` if this
+                              template does not exist or requires updates at
+                              any cost.
+    ``use_memcache``          Set this to ``True`` to enable memory caching.
+                              This is usually a good idea in production mode,
+                              but disable it during development since it won't
+                              reload template changes automatically. This only
+                              works in persistent environments like FastCGI.
+    ``memcache_size``         Number of template instance you want to cache.
+                              Defaults to ``40``.
+    ``cache_folder``          Set this to an existing directory to enable
+                              caching of templates on the file system. Note
+                              that this only affects templates transformed into
+                              python code. Default is ``None`` which means that
+                              caching is disabled.
+    ``auto_reload``           Set this to `False` for a slightly better
+                              performance. In that case of `getmtime_func` not
+                              being provided this won't have an effect.
+    ``cache_salt``            Optional unique number to not confuse the caching
+                              system when caching more than one template loader
+                              in the same folder.
+    ``reload_check_interval`` If `auto_reload` is enabled the source of a
+                              template is checked for changes at most once in
+                              this number of seconds. Defaults to ``0`` which
+                              means on every load. *New in Jinja 1.3*
+    ``compress_cache``        Set this to ``True`` to compress the templates
+                              in the disk cache with zlib or to a codec from
+                              `jinja.compression`. *New in Jinja 1.3*
+    ``compress_threshold``    Templates smaller than this number of bytes are
+                              not compressed. Defaults to ``1024``.
+    ``bytecode_cache``        A bytecode cache from `jinja.bccache` that
+                              stores the compiled templates in addition to
+                              the `cache_folder`. *New in Jinja 1.3*
+    ``cache_max_size``        The maximum size of the files in the
+                              `cache_folder` in bytes. The least recently
+                              used files are removed in the background if
+                              the folder gets bigger. *New in Jinja 1.3*
+    ``cache_max_entries``     The maximum number of files in the
+                              `cache_folder`. *New in Jinja 1.3*
+    ``cache_max_age``         Cache files not used for this number of
+                              seconds are removed. *New in Jinja 1.3*
+    ========================= =================================================
     """
 
     def __init__(self, loader_func, getmtime_func=None, use_memcache=False,
                  memcache_size=40, cache_folder=None, auto_reload=True,
-                 cache_salt=None):
+                 cache_salt=None, reload_check_interval=0,
+                 compress_cache=False, compress_threshold=1024,
+                 bytecode_cache=None, cache_max_size=None,
+                 cache_max_entries=None, cache_max_age=None):
         BaseFunctionLoader.__init__(self, loader_func)
         # when changing the signature also check the jinja.plugin function
         # loader instantiation.
@@ -748,7 +1367,11 @@ class FunctionLoader(CachedLoaderMixin, BaseFunctionLoader):
         if auto_reload and getmtime_func is None:
             auto_reload = False
         CachedLoaderMixin.__init__(self, use_memcache, memcache_size,
-                                   cache_folder, auto_reload, cache_salt)
+                                   cache_folder, auto_reload, cache_salt,
+                                   reload_check_interval, False,
+                                   compress_cache, compress_threshold,
+                                   bytecode_cache, cache_max_size,
+                                   cache_max_entries, cache_max_age)
 
     def check_source_changed(self, environment, name):
         return self.getmtime_func(name)
@@ -778,6 +1401,68 @@ class DictLoader(BaseLoader):
         raise TemplateNotFound(name)
 
 
+class BundleLoader(BaseLoader):
+    """
+    Loads precompiled templates from a bundle created by the
+    `jinja.precompile.build_bundle` function:
+
+    .. sourcecode:: python
+
+        from jinja import Environment, BundleLoader
+        e = Environment(loader=BundleLoader('templates.bundle'))
+
+    The bundle is memory mapped and a template is unmarshalled the first
+    time it's requested.  Because the bundle has no template sources the
+    `get_source` and `parse` methods and templates not in the bundle are
+    forwarded to the `fallback` loader if one is given.  This is also
+    the case if a translator other than the python translator is used or
+    if an entry of the bundle is corrupt.  Opening a bundle created by
+    another python or Jinja version raises a `ValueError`.
+
+    *New in Jinja 1.3*
+    """
+
+    def __init__(self, filename, fallback=None):
+        self.bundle = Bundle(filename)
+        self.fallback = fallback
+        self._templates = {}
+        self._lock = Lock()
+
+    def get_source(self, environment, name, parent):
+        if self.fallback is None:
+            raise TemplateNotFound(name)
+        return self.fallback.get_source(environment, name, parent)
+
+    def parse(self, environment, name, parent):
+        if self.fallback is None:
+            raise TemplateNotFound(name)
+        return self.fallback.parse(environment, name, parent)
+
+    def load(self, environment, name, translator):
+        tmpl = None
+        if issubclass(translator, PythonTranslator) and name in self.bundle:
+            tmpl = self._templates.get(name)
+            if tmpl is None:
+                self._lock.acquire()
+                try:
+                    tmpl = self._templates.get(name)
+                    if tmpl is None:
+                        try:
+                            tmpl = Template.load(environment,
+                                                 self.bundle.get_data(name))
+                        except (ValueError, EOFError):
+                            pass
+                        else:
+                            self._templates[name] = tmpl
+                finally:
+                    self._lock.release()
+        if tmpl is None:
+            if self.fallback is None:
+                raise TemplateNotFound(name)
+            return self.fallback.load(environment, name, translator)
+        return tmpl
+
+
 class ChoiceLoader(object):
     """
     A loader that tries multiple loaders in the order they are given to
@@ -789,37 +1474,159 @@ class ChoiceLoader(object):
         loader1 = FileSystemLoader("templates1")
         loader2 = FileSystemLoader("templates2")
         loader = ChoiceLoader([loader1, loader2])
+
+    With Jinja 1.3 onwards the loader can remember which loader serves a
+    template and which templates don't exist so that it doesn't have to
+    ask all the loaders each time.  Pass the number of seconds the
+    results are valid as `resolution_ttl`, or set `watch_files` to
+    ``True`` (or a watcher from `jinja.watcher`) to forget the results
+    for a template when a file of it is created, changed or removed in
+    the folders of the loaders providing a `get_source_filename` method.
+    Use `clear_resolution_cache` to forget all results.  Only the files of
+    the templates in the resolution cache are watched.  Without a
+    `resolution_ttl` results are not cached if one of the files can't be
+    watched, for example because the folder of a loader doesn't exist yet.
     """
 
-    def __init__(self, loaders):
+    #: the maximum number of templates remembered
+    resolution_cache_size = 1000
+
+    def __init__(self, loaders, resolution_ttl=None, watch_files=False):
         self.loaders = list(loaders)
+        self.resolution_ttl = resolution_ttl
+        if not watch_files:
+            self._watcher = None
+        elif watch_files is True:
+            from jinja.watcher import get_watcher
+            self._watcher = get_watcher()
+        else:
+            self._watcher = watch_files
+        if resolution_ttl is not None or self._watcher is not None:
+            self._resolved = CacheDict(self.resolution_cache_size)
+        else:
+            self._resolved = None
+        self._watched = {}
+        self._lock = Lock()
 
-    def get_source(self, environment, name, parent):
-        for loader in self.loaders:
+    def clear_resolution_cache(self):
+        """
+        Forget which loaders serve which templates.
+        """
+        if self._resolved is not None:
+            self._lock.acquire()
             try:
-                return loader.get_source(environment, name, parent)
-            except TemplateNotFound, e:
-                if e.name != name:
-                    raise
-                continue
-        raise TemplateNotFound(name)
+                self._resolved.clear()
+                for name in self._watched.keys():
+                    self._unwatch(name)
+            finally:
+                self._lock.release()
+
+    def get_source(self, environment, name, parent):
+        return self._resolve('get_source', environment, name, parent)
 
     def parse(self, environment, name, parent):
-        for loader in self.loaders:
+        return self._resolve('parse', environment, name, parent)
+
+    def load(self, environment, name, translator):
+        return self._resolve('load', environment, name, translator)
+
+    def _resolve(self, method, environment, name, *args):
+        """
+        Call `method` of the loader serving `name`.  The index of the
+        loader or ``-1`` for missing templates is cached if enabled.
+        """
+        index = self._get_resolved(name)
+        if index is not None:
+            if index < 0:
+                raise TemplateNotFound(name)
             try:
-                return loader.parse(environment, name, parent)
+                return getattr(self.loaders[index], method)(environment,
+                                                            name, *args)
             except TemplateNotFound, e:
                 if e.name != name:
                     raise
-                continue
-        raise TemplateNotFound(name)
+                # the template is gone, ask all the loaders again
+                self._forget(name)
 
-    def load(self, environment, name, translator):
-        for loader in self.loaders:
+        for index, loader in enumerate(self.loaders):
             try:
-                return loader.load(environment, name, translator)
+                rv = getattr(loader, method)(environment, name, *args)
             except TemplateNotFound, e:
                 if e.name != name:
                     raise
                 continue
+            self._remember(environment, name, index)
+            return rv
+        self._remember(environment, name, -1)
         raise TemplateNotFound(name)
+
+    def _get_resolved(self, name):
+        if self._resolved is None:
+            return None
+        entry = self._resolved.peek(name)
+        if entry is None:
+            return None
+        index, expires = entry
+        if expires is not None and expires < time.time():
+            return None
+        return index
+
+    def _remember(self, environment, name, index):
+        if self._resolved is None:
+            return
+        if self.resolution_ttl is not None:
+            expires = time.time() + self.resolution_ttl
+        else:
+            expires = None
+        self._lock.acquire()
+        try:
+            # a new file in the folder of a loader before the one serving
+            # the template (or anywhere for missing templates) changes the
+            # result, so all the possible files are watched.  if that's not
+            # possible the result is only cached if it expires.
+            if self._watcher is not None and name not in self._watched:
+                callback = lambda: self._forget(name)
+                filenames = []
+                watched = True
+                for loader in self.loaders:
+                    get_filename = getattr(loader, 'get_source_filename',
+                                           None)
+                    if get_filename is not None:
+                        filename = get_filename(environment, name)
+                        filenames.append(filename)
+                        if not self._watcher.watch(filename, callback):
+                            watched = False
+                self._watched[name] = (callback, filenames)
+                if not watched and self.resolution_ttl is None:
+                    self._unwatch(name)
+                    return
+
+            self._resolved[name] = (index, expires)
+
+            # stop watching the templates dropped from the full cache
+            if self._watcher is not None and \
+               len(self._watched) > len(self._resolved):
+                for other in self._watched.keys():
+                    if other not in self._resolved:
+                        self._unwatch(other)
+        finally:
+            self._lock.release()
+
+    def _forget(self, name):
+        self._lock.acquire()
+        try:
+            if name in self._resolved:
+                del self._resolved[name]
+            self._unwatch(name)
+        finally:
+            self._lock.release()
+
+    def _unwatch(self, name):
+        """
+        Stop watching the files of a template.  The caller has to hold
+        the lock.
+        """
+        if name in self._watched:
+            callback, filenames = self._watched.pop(name)
+            for filename in filenames:
+                self._watcher.unwatch(filename, callback)
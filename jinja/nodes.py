@@ -32,6 +32,29 @@ def get_nodes(nodetype, tree, exclude_root=True):
         todo.extend(node.get_child_nodes())
 
 
+def get_clone_memo(tree):
+    """
+    Return a memo for `copy.deepcopy` that maps all nodes of the tree that
+    don't contain a `Block` node to themselves. The translator only
+    modifies blocks (see `Block.replace`) so a deepcopy with this memo is
+    an independent clone for the translator but only copies the blocks and
+    the nodes that lead to them.
+    """
+    memo = {}
+    def walk(node):
+        has_block = node.__class__ is Block
+        for child in node.get_child_nodes():
+            if walk(child):
+                has_block = True
+        if not has_block:
+            memo[id(node)] = node
+        return has_block
+    # always copy the root node so that each copy is a new tree
+    if not walk(tree):
+        del memo[id(tree)]
+    return memo
+
+
 class NotPossible(NotImplementedError):
     """
     If a given node cannot do something.
@@ -105,6 +128,8 @@ class Template(Node):
         Node.__init__(self, lineno, filename)
         self.extends = extends
         self.body = body
+        #: the sha1 digest of the source, set by the parser
+        self.source_hash = None
 
     def get_items(self):
         return [self.extends, self.body]
@@ -14,10 +14,16 @@
     :copyright: 2007 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from copy import deepcopy
+from threading import Lock
 from jinja import nodes
 from jinja.datastructure import StateTest
 from jinja.exceptions import TemplateSyntaxError
-from jinja.utils import set
+from jinja.utils import set, CacheDict
 
 
 __all__ = ['Parser']
@@ -46,6 +52,21 @@ end_of_trans = StateTest.expect_token('endtrans')
 tuple_edge_tokens = set(['rparen', 'block_end', 'variable_end', 'in',
                          'recursive'])
 
+# cache for parsed templates shared by all environments.  The key is the
+# configuration key of the lexer, the filename and a checksum of the
+# source, the value the tree and the memo for `nodes.get_clone_memo`.
+_tree_cache = CacheDict(100)
+_tree_cache_lock = Lock()
+
+
+def get_source_hash(environment, source):
+    """
+    Return the sha1 digest of a template source.
+    """
+    if isinstance(source, str):
+        source = source.decode(environment.template_charset, 'ignore')
+    return sha1(source.encode('utf-8')).digest()
+
 
 class Parser(object):
     """
@@ -97,7 +118,9 @@ class Parser(object):
         #: get the `no_variable_block` flag
         self.no_variable_block = self.environment.lexer.no_variable_block
 
-        self.stream = environment.lexer.tokenize(source, filename)
+        #: the token stream is created on parsing, if the tree is not
+        #: in the tree cache
+        self.stream = None
 
     def parse_raw_directive(self):
         """
@@ -1154,10 +1177,28 @@ class Parser(object):
         """
         Parse the template and return a Template node. This also does some
         post processing sanitizing and parses for an extends tag.
+
+        Templates with the same source, filename and lexer configuration
+        result in the same tree, so they are only parsed once and a copy
+        of the cached tree is returned for them.
         """
         if self.closed:
             raise RuntimeError('parser is closed')
 
+        source_hash = get_source_hash(self.environment, self.source)
+        key = (self.environment.lexer.config_key, self.filename, source_hash)
+        _tree_cache_lock.acquire()
+        try:
+            cached = _tree_cache.get(key)
+        finally:
+            _tree_cache_lock.release()
+        if cached is not None:
+            self.close()
+            tree, memo = cached
+            return deepcopy(tree, memo.copy())
+
+        self.stream = self.environment.lexer.tokenize(self.source,
+                                                      self.filename)
         try:
             # get the leading whitespace, if we are not in a child
             # template we push that back to the stream later.
@@ -1176,10 +1217,20 @@ class Parser(object):
                     self.stream.shift(leading_whitespace)
 
             body = self.sanitize_tree(self.subparse(None), extends)
-            return nodes.Template(extends, body, 1, self.filename)
+            tree = nodes.Template(extends, body, 1, self.filename)
+            tree.source_hash = source_hash
         finally:
             self.close()
 
+        # the translator modifies the tree we return, so cache a copy
+        memo = nodes.get_clone_memo(tree)
+        _tree_cache_lock.acquire()
+        try:
+            _tree_cache[key] = (deepcopy(tree, memo.copy()), memo)
+        finally:
+            _tree_cache_lock.release()
+        return tree
+
     def close(self):
         """Clean up soon."""
         self.closed = True
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.precompile
+    ~~~~~~~~~~~~~~~~
+
+    Compiles all the templates of a `FileSystemLoader` or `PackageLoader`
+    into its cache folder ahead of time so that the application doesn't
+    have to compile them while serving requests:
+
+    .. sourcecode:: python
+
+        from jinja import Environment
+        from jinja.loaders import FileSystemLoader
+        from jinja.precompile import precompile
+
+        env = Environment(loader=FileSystemLoader('templates',
+                                                  cache_folder='/tmp/cache'))
+        for name, error in precompile(env, workers=4):
+            print 'could not compile %s: %s' % (name, error)
+
+    Alternatively `build_bundle` compiles the templates into a single
+    bundle file for the `BundleLoader` (see `jinja.bundle`).
+
+    The same is available as ``jinja-precompile`` console script. Keep in
+    mind that the compiled templates depend on the settings of the
+    environment (like the delimiters and the filters) and the names of the
+    cache files depend on the `cache_salt` of the loader which defaults to
+    the searchpath or the package name and path.  So the environment and
+    the loader have to be created with the same arguments as the ones of
+    the application.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+from jinja.loaders import CachedLoaderMixin, BaseFileSystemLoader, \
+     BasePackageLoader, FileSystemLoader, PackageLoader
+from jinja.translators.python import PythonTranslator
+from jinja.bundle import write_bundle
+
+
+__all__ = ['precompile', 'build_bundle', 'find_templates']
+
+
+#: the environment and loader used by `_compile`.  set by `_init_worker`
+_worker_state = None
+
+
+def find_templates(loader):
+    """
+    Return a sorted list of the names of all the files in the folder of
+    a `FileSystemLoader` or `PackageLoader`. Hidden files and folders are
+    skipped.
+    """
+    if isinstance(loader, BaseFileSystemLoader):
+        return loader.list_templates()
+    rv = []
+    if isinstance(loader, BasePackageLoader):
+        from pkg_resources import resource_listdir, resource_isdir
+        todo = ['']
+        while todo:
+            prefix = todo.pop()
+            folder = '/'.join([p for p in [loader.package_path, prefix] if p])
+            for filename in resource_listdir(loader.package_name, folder):
+                if filename[:1] == '.':
+                    continue
+                name = prefix and prefix + '/' + filename or filename
+                if resource_isdir(loader.package_name, folder + '/' +
+                                  filename):
+                    todo.append(name)
+                else:
+                    rv.append(name)
+    else:
+        raise TypeError('cannot find the templates of %r' % loader)
+    rv.sort()
+    return rv
+
+
+def _init_worker(environment, loader):
+    """
+    Set the environment and loader of the current process.
+    """
+    global _worker_state
+    _worker_state = (environment, loader)
+
+
+def _compile(args):
+    """
+    Compile one template. Returns the name, the error message or `None`
+    if the template compiled and the dumped template if requested.
+    """
+    name, dump = args
+    environment, loader = _worker_state
+    try:
+        tmpl = loader.load(environment, name, PythonTranslator)
+    except Exception, e:
+        return name, '%s: %s' % (e.__class__.__name__, e), None
+    if dump:
+        return name, None, tmpl.dump()
+    return name, None, None
+
+
+def _compile_all(environment, loader, names, workers, dump):
+    """
+    Compile the templates with the help of `_compile`, in multiple
+    processes if possible.
+    """
+    if names is None:
+        names = find_templates(loader)
+
+    try:
+        from multiprocessing import Pool, cpu_count
+    except ImportError:
+        Pool = None
+    else:
+        if workers is None:
+            workers = cpu_count()
+
+    args = [(name, dump) for name in names]
+    if Pool is None or workers <= 1 or len(names) <= 1:
+        _init_worker(environment, loader)
+        try:
+            return map(_compile, args)
+        finally:
+            _init_worker(None, None)
+    pool = Pool(workers, _init_worker, (environment, loader))
+    try:
+        return pool.map(_compile, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def precompile(environment, names=None, workers=None):
+    """
+    Compile the templates `names` (defaults to all templates found by
+    `find_templates`) into the cache folder of the loader of the
+    `environment` with the settings of the environment. The templates
+    are compiled by `workers` processes (defaults to the number of CPUs)
+    if the `multiprocessing` module is available.
+
+    Returns a list of ``(name, error)`` tuples for the templates that
+    failed to compile. Templates that are already in the cache folder and
+    up to date are not compiled again.
+    """
+    loader = environment.loader.loader
+    if not isinstance(loader, CachedLoaderMixin) or \
+       loader.cache_folder is None:
+        raise TypeError('precompiling requires a caching loader with a '
+                        'cache folder')
+    results = _compile_all(environment, loader, names, workers, False)
+    return [(name, error) for name, error, data in results
+            if error is not None]
+
+
+def build_bundle(environment, filename, names=None, workers=None):
+    """
+    Like `precompile` but writes the compiled templates into the bundle
+    `filename` instead of the cache folder.  The loader doesn't have to
+    be a caching loader.  Templates that failed to compile are not part
+    of the bundle and returned as list of ``(name, error)`` tuples.
+    """
+    results = _compile_all(environment, environment.loader.loader, names,
+                           workers, True)
+    write_bundle(filename, [(name, data) for name, error, data in results
+                            if error is None])
+    return [(name, error) for name, error, data in results
+            if error is not None]
+
+
+def main(args=None):
+    """
+    The ``jinja-precompile`` console script.
+    """
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] -e MODULE:NAME SEARCHPATH '
+                                'CACHE_FOLDER [TEMPLATE ...]\n       '
+                                '%prog [options] -e MODULE:NAME --bundle '
+                                'FILE SEARCHPATH [TEMPLATE ...]',
+                          description='Compile the templates of a folder '
+                                      'into the cache folder of Jinja or '
+                                      'into a bundle.')
+    parser.add_option('-p', '--package', action='store_true',
+                      help='load the templates from a package, SEARCHPATH '
+                           'is in the form package_name:package_path')
+    parser.add_option('-w', '--workers', type='int',
+                      help='the number of processes (defaults to the '
+                           'number of CPUs)')
+    parser.add_option('-s', '--salt', help='the cache salt of the loader')
+    parser.add_option('-b', '--bundle', metavar='FILE',
+                      help='write the templates into a bundle')
+    parser.add_option('-e', '--environment', metavar='MODULE:NAME',
+                      help='the environment of the application, its '
+                           'settings like the delimiters are used for '
+                           'compiling')
+    options, args = parser.parse_args(args)
+    if not options.environment:
+        parser.error('environment required')
+    if options.bundle:
+        if not args:
+            parser.error('searchpath required')
+        args.insert(1, None)
+    elif len(args) < 2:
+        parser.error('searchpath and cache folder required')
+
+    if options.package:
+        package_name, package_path = (args[0].split(':', 1) + [''])[:2]
+        loader = PackageLoader(package_name, package_path,
+                               cache_folder=args[1], cache_salt=options.salt)
+    else:
+        loader = FileSystemLoader(args[0], cache_folder=args[1],
+                                  cache_salt=options.salt)
+
+    module, name = options.environment.split(':', 1)
+    environment = getattr(__import__(module, None, None, [name]), name)
+    environment.loader = loader
+
+    if options.bundle:
+        errors = build_bundle(environment, options.bundle, args[2:] or None,
+                              options.workers)
+    else:
+        errors = precompile(environment, args[2:] or None, options.workers)
+    for name, error in errors:
+        print >> sys.stderr, '%s: %s' % (name, error)
+    return errors and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
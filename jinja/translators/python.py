@@ -30,6 +30,13 @@
 """
 import re
 import sys
+import imp
+import struct
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from zlib import adler32
 from jinja import nodes
 from jinja.nodes import get_nodes
 from jinja.parser import Parser
@@ -37,6 +44,7 @@ from jinja.exceptions import TemplateSyntaxError
 from jinja.translators import Translator
 from jinja.datastructure import TemplateStream
 from jinja.utils import set, capture_generator
+from jinja.compression import compress, decompress, is_compressed
 
 
 #: regular expression for the debug symbols
@@ -57,35 +65,130 @@ try:
 except SyntaxError:
     have_conditional_expr = False
 
+#: the first bytes of a dumped template
+bytecode_magic = 'JNJT'
+
+# the header after the magic: the magic number of the interpreter, the
+# start of the sha1 digest of the jinja version, the sha1 digest of the
+# template source and the adler32 checksum and size of the (maybe
+# compressed) marshalled data.
+bytecode_header = '<4s8s20sII'
+bytecode_header_size = len(bytecode_magic) + struct.calcsize(bytecode_header)
+no_source_hash = '\0' * 20
+
+
+def _get_version_digest():
+    """
+    Return the version field of the header.  Version strings can be
+    longer than the field, so the start of their digest is stored.
+    """
+    # the jinja package is not initialized yet when this module is
+    # imported, so import the version when needed
+    from jinja import __version__
+    return sha1(__version__).digest()[:8]
+
+
+def _unmarshal(data):
+    """
+    Unmarshal a string or memory mapped file.  Returns a tuple in the
+    form ``(code, dependencies, source_hash)`` or raises a `ValueError`
+    if the header doesn't match or the data is truncated or corrupt.
+    """
+    from marshal import loads
+    header = data[:bytecode_header_size]
+    if len(header) != bytecode_header_size or \
+       header[:len(bytecode_magic)] != bytecode_magic:
+        raise ValueError('not a dumped template')
+    magic, version, source_hash, checksum, size = \
+        struct.unpack(bytecode_header, header[len(bytecode_magic):])
+    if magic != imp.get_magic():
+        raise ValueError('template dumped by another python version')
+    if version != _get_version_digest():
+        raise ValueError('template dumped by another jinja version')
+    data = buffer(data, bytecode_header_size)
+    if len(data) != size or adler32(data) & 0xffffffff != checksum:
+        raise ValueError('dumped template is truncated or corrupt')
+    if is_compressed(data):
+        data = decompress(data)
+    try:
+        code, dependencies = loads(data)
+    except TypeError:
+        # older python versions only unmarshal strings
+        code, dependencies = loads(str(data))
+    if source_hash == no_source_hash:
+        source_hash = None
+    return code, dependencies, source_hash
+
+
+def _unmarshal_file(f):
+    """
+    Unmarshal the data in a file.  Real files are memory mapped so that
+    the data is unmarshalled without copying it into a read buffer first.
+    """
+    try:
+        if f.tell() != 0:
+            raise ValueError()
+        from mmap import mmap, ACCESS_READ
+        data = mmap(f.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, ImportError, EnvironmentError, ValueError):
+        return _unmarshal(f.read())
+    try:
+        return _unmarshal(data)
+    finally:
+        data.close()
+
 
 class Template(object):
     """
-    Represents a finished template.
+    Represents a finished template.  The code is executed the first time
+    the template is rendered.
     """
 
-    def __init__(self, environment, code):
+    def __init__(self, environment, code, dependencies=(), source_hash=None):
         self.environment = environment
         self.code = code
         self.generate_func = None
 
-    def dump(self, stream=None):
-        """Dump the template into python bytecode."""
-        if stream is not None:
-            from marshal import dump
-            dump(self.code, stream)
-        else:
-            from marshal import dumps
-            return dumps(self.code)
+        #: the templates compiled into this template (parent templates
+        #: and includes) as tuples in the form ``(name, last_change)``.
+        self.dependencies = tuple(dependencies)
+
+        #: the sha1 digest of the template source or `None`
+        self.source_hash = source_hash
+
+    def dump(self, stream=None, codec=None, threshold=0):
+        """
+        Dump the template into python bytecode.  If a `codec` from the
+        `jinja.compression` module is given the bytecode is compressed
+        if it's at least `threshold` bytes long.
+
+        The bytecode starts with a header with the python and Jinja
+        version, the hash of the source and a checksum, `load` refuses
+        to load templates dumped by other versions.
+        """
+        from marshal import dumps
+        data = dumps((self.code, self.dependencies))
+        if codec is not None:
+            data = compress(data, codec, threshold)
+        data = bytecode_magic + struct.pack(bytecode_header,
+            imp.get_magic(), _get_version_digest(),
+            self.source_hash or no_source_hash,
+            adler32(data) & 0xffffffff, len(data)) + data
+        if stream is None:
+            return data
+        stream.write(data)
 
     def load(environment, data):
-        """Load the template from python bytecode."""
+        """
+        Load the template from bytecode created by `dump`.  Raises a
+        `ValueError` if the bytecode was dumped by another version of
+        python or Jinja or if it's corrupt.
+        """
         if isinstance(data, basestring):
-            from marshal import loads
-            code = loads(data)
+            data = _unmarshal(data)
         else:
-            from marshal import load
-            code = load(data)
-        return Template(environment, code)
+            data = _unmarshal_file(data)
+        return Template(environment, *data)
     load = staticmethod(load)
 
     def render(self, *args, **kwargs):
@@ -201,6 +304,9 @@ class PythonTranslator(Translator):
         self.need_set_import = False
         #: flag for regular expressions
         self.compiled_regular_expressions = {}
+        #: filters with constant arguments resolved once per template
+        #: if the environment has `inline_filters` enabled.
+        self.inlined_filters = {}
 
         #: bind the nodes to the callback functions. There are
         #: some missing! A few are specified in the `unhandled`
@@ -264,9 +370,12 @@ class PythonTranslator(Translator):
         `Template` instance.
         """
         translator = PythonTranslator(environment, node, source)
+        loader = translator.loader
         filename = node.filename or '<template>'
         source = translator.translate()
-        return Template(environment, compile(source, filename, 'exec'))
+        return Template(environment, compile(source, filename, 'exec'),
+                        loader.dependencies,
+                        getattr(node, 'source_hash', None))
     process = staticmethod(process)
 
     # -- private helper methods
@@ -287,6 +396,40 @@ class PythonTranslator(Translator):
             len(args) == 1 and ',' or ''
         )
 
+    def filter_calls(self, value, filters):
+        """
+        Return the code that applies `filters` on the code `value`.  If the
+        environment inlines filters those with constant arguments are
+        called directly, the others are applied by `apply_filters`.
+        """
+        inline = self.environment.inline_filters
+        pending = []
+        def apply_pending(value):
+            if not pending:
+                return value
+            self.used_shortcuts.add('apply_filters')
+            value = 'apply_filters(%s, context, %s)' % (
+                value,
+                self.to_tuple(pending)
+            )
+            del pending[:]
+            return value
+        for name, args in filters:
+            code = self.to_tuple(map(self.handle_node, args))
+            if not inline or [arg for arg in args if arg.__class__
+                              is not nodes.ConstantExpression]:
+                pending.append('(%r, %s)' % (name, code))
+                continue
+            key = (name, code)
+            if key not in self.inlined_filters:
+                self.inlined_filters[key] = 'filter_%d' % \
+                                            len(self.inlined_filters)
+            value = '%s(environment, context, %s)' % (
+                self.inlined_filters[key],
+                apply_pending(value)
+            )
+        return apply_pending(value)
+
     def nodeinfo(self, node, force=False):
         """
         Return a comment that holds node information or None
@@ -446,6 +589,16 @@ class PythonTranslator(Translator):
             for regex, name in self.compiled_regular_expressions.iteritems():
                 lines.append('%s = re.compile(%r)' % (name, regex))
 
+        # resolve the inlined filters
+        if self.inlined_filters:
+            lines.append('\n# Filters with constant arguments')
+            items = [(name, key) for key, name in
+                     self.inlined_filters.iteritems()]
+            items.sort()
+            for name, (filtername, args) in items:
+                lines.append('%s = environment.resolve_filter(%r, %s)' %
+                             (name, filtername, args))
+
         lines.append(
             '\n# Aliases for some speedup\n'
             '%s\n\n'
@@ -837,13 +990,8 @@ class PythonTranslator(Translator):
         write('context.pop()')
         write('if 0: yield None')
         self.indention -= 1
-        self.used_shortcuts.add('apply_filters')
-        write('yield apply_filters(buffereater(filtered)(), context, %s)' %
-            self.to_tuple(['(%r, %s)' % (
-                name,
-                self.to_tuple(map(self.handle_node, args))
-            ) for name, args in node.filters])
-        )
+        write('yield %s' % self.filter_calls('buffereater(filtered)()',
+                                             node.filters))
         self.used_utils.add('buffereater')
         return '\n'.join(buf)
 
@@ -988,14 +1136,7 @@ class PythonTranslator(Translator):
         """
         We use the pipe operator for filtering.
         """
-        self.used_shortcuts.add('apply_filters')
-        return 'apply_filters(%s, context, %s)' % (
-            self.handle_node(node.node),
-            self.to_tuple(['(%r, %s)' % (
-                name,
-                self.to_tuple(map(self.handle_node, args))
-            ) for name, args in node.filters])
-        )
+        return self.filter_calls(self.handle_node(node.node), node.filters)
 
     def handle_call_expr(self, node, extra_kwargs=None):
         """
@@ -19,18 +19,14 @@ from jinja import nodes
 from jinja.exceptions import SecurityException, TemplateNotFound
 from jinja.datastructure import TemplateData
 
-# the python2.4 version of deque is missing the remove method
-# because a for loop with a lookup for the missing value written
-# in python is slower we just use deque if we have python2.5 or higher
+# python2.3 has no deque
 try:
     from collections import deque
-    deque.remove
-except (ImportError, AttributeError):
+except ImportError:
     class deque(list):
         """
         Minimal subclass of list that provides the deque
-        interface used by the native `BaseContext` and the
-        `CacheDict`
+        interface used by the native `BaseContext`.
         """
         def appendleft(self, item):
             list.insert(self, 0, item)
@@ -404,6 +400,44 @@ def collect_translations(ast):
     return result
 
 
+def write_atomically(filename, data):
+    """
+    Write `data` into a temporary file next to `filename` and rename it.
+    Other processes reading the file see either the old or the new data,
+    never a partly written file.
+    """
+    import os
+    from thread import get_ident
+    tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), get_ident())
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(tmp_filename, flags, 0666)
+    except OSError:
+        # left behind by a crashed process with the same pid
+        os.remove(tmp_filename)
+        fd = os.open(tmp_filename, flags, 0666)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp_filename, filename)
+        except OSError:
+            # windows doesn't replace existing files
+            if not os.path.exists(filename):
+                raise
+            os.remove(filename)
+            os.rename(tmp_filename, filename)
+    except:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
 class DebugHelper(object):
     """
     Debugging Helper. Available in the template as "debug".
@@ -499,30 +533,25 @@ class CacheDict(object):
 
     If you want to iterate the other way round use ``reverse(cache)``.
 
-    Implementation note: This is not a nice way to solve that problem but
-    for smaller capacities it's faster than a linked list.
-    Perfect for template environments where you don't expect too many
-    different keys.
+    Implementation note: The items are stored in a dict that maps the
+    keys to the links of a circular doubly linked list ordered by the
+    usage, so that lookups, updates and removals don't depend on the
+    capacity. A link is a list in the form ``[prev, next, key, value]``.
     """
 
     def __init__(self, capacity):
         self.capacity = capacity
         self._mapping = {}
-        self._queue = deque()
-
-        # alias all queue methods for faster lookup
-        self._popleft = self._queue.popleft
-        self._pop = self._queue.pop
-        self._remove = self._queue.remove
-        self._append = self._queue.append
+        self._root = root = []
+        root[:] = [root, root, None, None]
 
     def copy(self):
         """
         Return an shallow copy of the instance.
         """
         rv = CacheDict(self.capacity)
-        rv._mapping.update(self._mapping)
-        rv._queue = self._queue[:]
+        for key in self.__reversed__():
+            rv[key] = self._mapping[key][3]
         return rv
 
     def get(self, key, default=None):
@@ -533,6 +562,17 @@ class CacheDict(object):
             return self[key]
         return default
 
+    def peek(self, key, default=None):
+        """
+        Return an item from the cache dict or `default` without moving
+        it up.  Unlike the other methods this can be used while another
+        thread is modifying the cache dict.
+        """
+        link = self._mapping.get(key)
+        if link is None:
+            return default
+        return link[3]
+
     def setdefault(self, key, default=None):
         """
         Set `default` if the key is not in the cache otherwise
@@ -548,7 +588,8 @@ class CacheDict(object):
         Clear the cache dict.
         """
         self._mapping.clear()
-        self._queue.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
 
     def __contains__(self, key):
         """
@@ -565,7 +606,7 @@ class CacheDict(object):
     def __repr__(self):
         return '<%s %r>' % (
             self.__class__.__name__,
-            self._mapping
+            dict([(key, link[3]) for key, link in self._mapping.iteritems()])
         )
 
     def __getitem__(self, key):
@@ -575,11 +616,18 @@ class CacheDict(object):
 
         Raise an `KeyError` if it does not exist.
         """
-        rv = self._mapping[key]
-        if self._queue[-1] != key:
-            self._remove(key)
-            self._append(key)
-        return rv
+        link = self._mapping[key]
+        root = self._root
+        last = root[0]
+        if link is not last:
+            # unlink the item and append it again
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            link[0] = last
+            link[1] = root
+            last[1] = root[0] = link
+        return link[3]
 
     def __setitem__(self, key, value):
         """
@@ -587,44 +635,59 @@ class CacheDict(object):
         has the highest priority then.
         """
         if key in self._mapping:
-            self._remove(key)
-        elif len(self._mapping) == self.capacity:
-            del self._mapping[self._popleft()]
-        self._append(key)
-        self._mapping[key] = value
+            self[key]
+            self._mapping[key][3] = value
+            return
+        root = self._root
+        if len(self._mapping) >= self.capacity:
+            oldest = root[1]
+            root[1] = next = oldest[1]
+            next[0] = root
+            del self._mapping[oldest[2]]
+        last = root[0]
+        last[1] = root[0] = self._mapping[key] = [last, root, key, value]
 
     def __delitem__(self, key):
         """
         Remove an item from the cache dict.
         Raise an `KeyError` if it does not exist.
         """
-        del self._mapping[key]
-        self._remove(key)
+        prev, next = self._mapping.pop(key)[:2]
+        prev[1] = next
+        next[0] = prev
 
     def __iter__(self):
         """
         Iterate over all values in the cache dict, ordered by
         the most recent usage.
         """
-        return reversed(self._queue)
+        root = self._root
+        link = root[0]
+        while link is not root:
+            yield link[2]
+            link = link[0]
 
     def __reversed__(self):
         """
         Iterate over the values in the cache dict, oldest items
         coming first.
         """
-        return iter(self._queue)
+        root = self._root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
 
     __copy__ = copy
 
-    def __deepcopy__(self):
+    def __deepcopy__(self, memo=None):
         """
         Return a deep copy of the cache dict.
         """
         from copy import deepcopy
         rv = CacheDict(self.capacity)
-        rv._mapping = deepcopy(self._mapping)
-        rv._queue = deepcopy(self._queue)
+        for key in self.__reversed__():
+            rv[deepcopy(key, memo)] = deepcopy(self._mapping[key][3], memo)
         return rv
 
 
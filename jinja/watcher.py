@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.watcher
+    ~~~~~~~~~~~~~
+
+    File watchers for the caching loaders. Instead of checking the source
+    of a template for changes each time it's loaded a loader can register
+    the files of its templates at a watcher that calls back if one of them
+    changes.
+
+    On Linux the `InotifyWatcher` is used which gets notified by the kernel,
+    on other systems (or if ctypes is not available) a `PollingWatcher`
+    checks the modification times of the files in a background thread.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import struct
+from os import path
+from select import select
+from threading import Thread, Lock
+
+
+__all__ = ['get_watcher', 'InotifyWatcher', 'PollingWatcher']
+
+
+# inotify event flags, see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# the header of an inotify event (wd, mask, cookie, len)
+inotify_event = 'iIII'
+inotify_event_size = struct.calcsize(inotify_event)
+
+
+class BaseWatcher(object):
+    """
+    Baseclass for the watchers. Subclasses have to call `notify` with the
+    filename if one of the files passed to `watch` changes.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._callbacks = {}
+        self.running = True
+
+    def watch(self, filename, callback):
+        """
+        Call `callback` without arguments if the file changes.  Returns
+        `False` if the file can't be watched, for example because its
+        folder doesn't exist.
+        """
+        filename = path.abspath(filename)
+        self._lock.acquire()
+        try:
+            self._callbacks.setdefault(filename, []).append(callback)
+        finally:
+            self._lock.release()
+        return True
+
+    def unwatch(self, filename, callback):
+        """
+        Stop calling a callback passed to `watch` for the file.
+        """
+        filename = path.abspath(filename)
+        self._lock.acquire()
+        try:
+            self._unwatch(filename, callback)
+        finally:
+            self._lock.release()
+
+    def _unwatch(self, filename, callback):
+        callbacks = self._callbacks.get(filename)
+        if callbacks is not None and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._callbacks[filename]
+
+    def notify(self, filename):
+        """
+        Call the callbacks registered for a filename.
+        """
+        self._lock.acquire()
+        try:
+            callbacks = list(self._callbacks.get(filename, ()))
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback()
+
+    def stop(self):
+        """
+        Stop watching.
+        """
+        self.running = False
+
+    def _start(self, target):
+        thread = Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+
+
+class PollingWatcher(BaseWatcher):
+    """
+    Checks the modification times of the files every `interval` seconds.
+    """
+
+    def __init__(self, interval=1):
+        BaseWatcher.__init__(self)
+        self.interval = interval
+        self._times = {}
+        self._start(self._run)
+
+    def watch(self, filename, callback):
+        filename = path.abspath(filename)
+        self._lock.acquire()
+        try:
+            if filename not in self._times:
+                self._times[filename] = self._getmtime(filename)
+        finally:
+            self._lock.release()
+        return BaseWatcher.watch(self, filename, callback)
+
+    def _unwatch(self, filename, callback):
+        BaseWatcher._unwatch(self, filename, callback)
+        if filename not in self._callbacks:
+            self._times.pop(filename, None)
+
+    def _getmtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def _run(self):
+        from time import sleep
+        while self.running:
+            sleep(self.interval)
+            self._lock.acquire()
+            try:
+                items = self._times.items()
+            finally:
+                self._lock.release()
+            for filename, last_change in items:
+                mtime = self._getmtime(filename)
+                if mtime != last_change:
+                    self._lock.acquire()
+                    try:
+                        if filename in self._times:
+                            self._times[filename] = mtime
+                    finally:
+                        self._lock.release()
+                    self.notify(filename)
+
+
+class InotifyWatcher(BaseWatcher):
+    """
+    Uses the Linux inotify API through ctypes. Because editors often
+    replace files instead of writing to them the folders of the files
+    are watched. Raises an `OSError` if inotify is not available.  Files
+    in folders that don't exist can't be watched.
+    """
+
+    def __init__(self):
+        BaseWatcher.__init__(self)
+        import ctypes
+        from ctypes.util import find_library
+        libc = ctypes.CDLL(find_library('c') or 'libc.so.6')
+        try:
+            self._add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError('inotify is not supported')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError('inotify_init failed')
+        self._folders = {}
+        self._start(self._run)
+
+    def watch(self, filename, callback):
+        folder = path.dirname(path.abspath(filename))
+        self._lock.acquire()
+        try:
+            if folder not in self._folders.values():
+                wd = self._add_watch(self._fd, folder, IN_EVENTS)
+                if wd < 0:
+                    return False
+                self._folders[wd] = folder
+        finally:
+            self._lock.release()
+        return BaseWatcher.watch(self, filename, callback)
+
+    def _run(self):
+        try:
+            while self.running:
+                if not select([self._fd], [], [], 1)[0]:
+                    continue
+                data = os.read(self._fd, 16384)
+                pos = 0
+                while pos < len(data):
+                    wd, mask, cookie, length = struct.unpack(inotify_event,
+                        data[pos:pos + inotify_event_size])
+                    pos += inotify_event_size
+                    name = data[pos:pos + length].rstrip('\0')
+                    pos += length
+                    if mask & IN_IGNORED:
+                        self._lock.acquire()
+                        try:
+                            self._folders.pop(wd, None)
+                        finally:
+                            self._lock.release()
+                        continue
+                    folder = self._folders.get(wd)
+                    if folder is not None and name:
+                        self.notify(path.join(folder, name))
+        finally:
+            os.close(self._fd)
+
+
+def get_watcher(interval=1):
+    """
+    Return an `InotifyWatcher` if possible, otherwise a `PollingWatcher`
+    that checks the files every `interval` seconds.
+    """
+    try:
+        return InotifyWatcher()
+    except (ImportError, OSError, AttributeError):
+        return PollingWatcher(interval)
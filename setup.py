@@ -136,6 +136,9 @@ setup(
     entry_points='''
     [python.templating.engines]
     jinja = jinja.plugin:BuffetPlugin
+
+    [console_scripts]
+    jinja-precompile = jinja.precompile:main
     ''',
     extras_require={'plugin': ['setuptools>=0.6a2']},
     features={
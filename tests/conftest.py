@@ -75,18 +75,30 @@ simple_env = Environment(trim_blocks=True, friendly_traceback=False, loader=load
 
 class MemcacheClient(object):
     """
-    Helper for the loader test.
+    Helper for the loader test.  Counts the requests in `requests`.
     """
 
-    def __init__(self, hosts):
+    def __init__(self, hosts=None):
         self.cache = {}
+        self.requests = 0
 
     def get(self, name):
+        self.requests += 1
         return self.cache.get(name)
 
-    def set(self, name, data, time):
+    def set(self, name, data, time=0):
+        self.requests += 1
         self.cache[name] = data
 
+    def get_multi(self, names):
+        self.requests += 1
+        return dict([(name, self.cache[name]) for name in names
+                     if name in self.cache])
+
+    def set_multi(self, mapping, time=0):
+        self.requests += 1
+        self.cache.update(mapping)
+
 sys.modules['memcache'] = memcache = type(sys)('memcache')
 memcache.Client = MemcacheClient
 
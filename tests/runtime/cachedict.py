@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# CacheDict benchmark
+#
+# Objective: compare the linked list based `CacheDict` with the deque
+# based implementation it replaced for different capacities.  Every
+# iteration looks up one key (cache hits only) and replaces one item.
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import timeit
+from random import Random
+from collections import deque
+from jinja.utils import CacheDict
+
+
+class DequeCacheDict(object):
+    """The `CacheDict` of Jinja 1.2."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._mapping = {}
+        self._queue = deque()
+        self._popleft = self._queue.popleft
+        self._remove = self._queue.remove
+        self._append = self._queue.append
+
+    def __getitem__(self, key):
+        rv = self._mapping[key]
+        if self._queue[-1] != key:
+            self._remove(key)
+            self._append(key)
+        return rv
+
+    def __setitem__(self, key, value):
+        if key in self._mapping:
+            self._remove(key)
+        elif len(self._mapping) == self.capacity:
+            del self._mapping[self._popleft()]
+        self._append(key)
+        self._mapping[key] = value
+
+
+def make_test(cls, capacity):
+    cache = cls(capacity)
+    for x in xrange(capacity):
+        cache[x] = x
+    random = Random(capacity)
+    keys = [random.randrange(capacity) for x in xrange(1000)]
+    def test():
+        for key in keys:
+            cache[key]
+            cache[key] = key
+    return test
+
+
+def run(capacities=(40, 1000, 10000), number=10):
+    for capacity in capacities:
+        for cls in CacheDict, DequeCacheDict:
+            t = timeit.Timer(make_test(cls, capacity))
+            time = t.timeit(number=number) / number
+            print '%-15s capacity %-6d %12.2f ms' % (cls.__name__, capacity,
+                                                     1000 * time)
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or (40, 1000, 10000))
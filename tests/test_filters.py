@@ -301,3 +301,30 @@ def test_groupby(env):
 def test_filtertag(env):
     tmpl = env.from_string(FILTERTAG)
     assert tmpl.render() == 'fooBAR'
+
+
+def test_inline_filters():
+    from jinja import Environment
+    from jinja.exceptions import FilterNotFound
+    calls = []
+    def do_repeat(n):
+        calls.append(n)
+        return lambda env, context, value: value * n
+    env = Environment(inline_filters=True)
+    env.filters['repeat'] = do_repeat
+    tmpl = env.from_string('{{ "a"|repeat(2)|upper|repeat(n) }}|'
+                           '{% filter repeat(2) %}b{% endfilter %}')
+    assert tmpl.render(n=1) == 'AA|bb'
+    assert tmpl.render(n=2) == 'AAAA|bb'
+    # the filter with the constant argument is shared by both calls
+    # and created once, the one with the variable once per rendering
+    assert calls == [2, 1, 2]
+    tmpl = env.from_string('{% if false %}{{ 1|missing }}{% endif %}')
+    assert tmpl.render() == ''
+    tmpl = env.from_string('{{ 1|missing }}')
+    try:
+        tmpl.render()
+    except FilterNotFound:
+        pass
+    else:
+        raise AssertionError('expected filter exception')
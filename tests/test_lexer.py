@@ -58,3 +58,78 @@ def test_operators(env):
         stream = env.lexer.tokenize('{{ %s }}' % test)
         stream.next()
         assert stream.current.type == expect
+
+
+def test_tokeniter(env):
+    tokens = list(env.lexer.tokeniter('foo\n{% if (a, b) %}{{ 42 }}{% endif %}'))
+    assert tokens == [
+        (1, 'data', 'foo\n'),
+        (2, 'block_begin', '{%'),
+        (2, 'name', 'if'),
+        (2, 'operator', '('),
+        (2, 'name', 'a'),
+        (2, 'operator', ','),
+        (2, 'name', 'b'),
+        (2, 'operator', ')'),
+        (2, 'block_end', '%}'),
+        (2, 'variable_begin', '{{'),
+        (2, 'integer', '42'),
+        (2, 'variable_end', '}}'),
+        (2, 'block_begin', '{%'),
+        (2, 'name', 'endif'),
+        (2, 'block_end', '%}')
+    ]
+
+
+def test_linenos(env):
+    tokens = list(env.lexer.tokeniter('a\n\nb{# x\ny #}\n{{\nfoo\n}}'))
+    assert [(lineno, token) for lineno, token, value in tokens] == [
+        (1, 'data'),
+        (3, 'comment_begin'),
+        (3, 'comment'),
+        (4, 'comment_end'),
+        (5, 'variable_begin'),
+        (6, 'name'),
+        (7, 'variable_end')
+    ]
+
+
+def test_interned_token_types(env):
+    stream = env.lexer.tokenize('{% for item in seq %}')
+    for token in stream:
+        assert token.type is intern(token.type)
+
+
+def test_unicode_whitespace(env):
+    tmpl = env.from_string(u'{{ 　foo\xa0 -}}\xa0{{ foo }}')
+    assert tmpl.render(foo=42) == u'42\xa042'
+
+
+def test_ascii_numbers(env):
+    from jinja.exceptions import TemplateSyntaxError
+    native = env.lexer.native
+    try:
+        for env.lexer.native in False, native:
+            assert [x[1:] for x in env.lexer.tokeniter(u'{{ 42 0.5 }}')
+                    ][1:-1] == [('integer', u'42'), ('float', u'0.5')]
+            try:
+                list(env.lexer.tokeniter(u'{{ \u0664\u0662 }}'))
+            except TemplateSyntaxError:
+                pass
+            else:
+                raise AssertionError('non-ascii digits lexed as a number')
+    finally:
+        env.lexer.native = native
+
+
+def test_native_tokenizer(env):
+    if not env.lexer.native:
+        return
+    source = u'{# c\n#}a {%- raw %}{{ x }}{% endraw -%}\n{{ b|e("\\"", 1.5) }}' \
+             u'{% for x in (y, [z]) %}\n　{% endfor %}'
+    env.lexer.native = False
+    try:
+        expected = list(env.lexer.tokeniter(source))
+    finally:
+        env.lexer.native = True
+    assert list(env.lexer.tokeniter(source)) == expected
@@ -7,10 +7,13 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
 import time
+import shutil
 import tempfile
 from jinja import Environment, loaders
 from jinja.exceptions import TemplateNotFound
+from memcache import Client as MemcacheClient
 
 
 dict_loader = loaders.DictLoader({
@@ -32,6 +35,35 @@ class FakeLoader(loaders.BaseLoader):
     local_attr = 42
 
 
+def with_folders(test):
+    """
+    Wrap a test that takes the paths of temporary folders as arguments.
+    The folders are created before and removed after the test.
+    """
+    def run_test():
+        folders = [tempfile.mkdtemp() for x in
+                   xrange(test.func_code.co_argcount)]
+        try:
+            test(*folders)
+        finally:
+            for folder in folders:
+                shutil.rmtree(folder)
+    return run_test
+
+
+def write_file(filename, data, mtime=None):
+    """
+    Write `data` into a file and optionally set its modification time.
+    """
+    f = file(filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+
 def test_dict_loader():
     env = Environment(loader=dict_loader)
     tmpl = env.get_template('justdict.html')
@@ -176,3 +208,684 @@ True
 >>> tmpl1 == tmpl2
 False
 '''
+
+
+class SlowLoader(loaders.CachedLoaderMixin, loaders.BaseLoader):
+
+    def __init__(self):
+        loaders.CachedLoaderMixin.__init__(self, True, 40, None, False)
+        self.loaded = []
+
+    def get_source(self, environment, name, parent):
+        self.loaded.append(name)
+        time.sleep(0.05)
+        return 'Template %s' % name
+
+
+def test_threaded_loading():
+    from threading import Thread
+    env = Environment(loader=SlowLoader())
+    templates = {}
+    def load(name):
+        templates.setdefault(name, set()).add(env.get_template(name))
+    threads = [Thread(target=load, args=(name,)) for name in 'abababab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(env.loader.loaded) == ['a', 'b']
+    assert [len(templates[name]) for name in 'ab'] == [1, 1]
+    assert 0 < env.loader.coalesced_loads <= 6
+
+
+def test_reload_check_interval():
+    checked = []
+    def getmtime(name):
+        checked.append(name)
+        return 0
+    loader = loaders.FunctionLoader({'a': 'A'}.get, getmtime, True,
+                                    reload_check_interval=3600)
+    env = Environment(loader=loader)
+    for x in xrange(3):
+        assert env.get_template('a').render() == 'A'
+    assert checked == ['a']
+    loader.clear_memcache()
+    env.get_template('a')
+    assert checked == ['a', 'a']
+
+
+def test_dependency_invalidation(searchpath, cache_folder):
+    def write(name, source, mtime):
+        write_file(os.path.join(searchpath, name), source, mtime)
+    write('layout.html', '[{% block body %}{% endblock %}]', 1000)
+    write('child.html', '{% extends "layout.html" %}{% block body %}'
+                        '{% include "part.html" %}{% endblock %}', 1000)
+    write('part.html', 'A', 1000)
+    loader = loaders.FileSystemLoader(searchpath, True, 40, cache_folder)
+    env = Environment(loader=loader)
+    assert env.get_template('child.html').render() == '[A]'
+    assert env.get_template('child.html').dependencies == (
+        ('layout.html', 1000), ('part.html', 1000))
+    write('part.html', 'B', 2000)
+    assert env.get_template('child.html').render() == '[B]'
+    write('layout.html', '<{% block body %}{% endblock %}>', 2000)
+    env = Environment(loader=loaders.FileSystemLoader(searchpath,
+                      cache_folder=cache_folder))
+    assert env.get_template('child.html').render() == '<B>'
+test_dependency_invalidation = with_folders(test_dependency_invalidation)
+
+
+def test_watch_files(searchpath):
+    from jinja.watcher import PollingWatcher
+    def write(name, source):
+        write_file(os.path.join(searchpath, name), source)
+    def wait_for(name, result):
+        for x in xrange(100):
+            if env.get_template(name).render() == result:
+                return
+            time.sleep(0.05)
+        raise AssertionError('template not reloaded')
+    write('layout.html', '[{% block body %}{% endblock %}]')
+    write('child.html', '{% extends "layout.html" %}'
+                        '{% block body %}A{% endblock %}')
+    loader = loaders.FileSystemLoader(searchpath, True, watch_files=True)
+    env = Environment(loader=loader)
+    assert env.get_template('child.html').render() == '[A]'
+    write('layout.html', '<{% block body %}{% endblock %}>')
+    wait_for('child.html', '<A>')
+
+    # the polling watcher
+    watcher = PollingWatcher(0.01)
+    loader = loaders.FileSystemLoader(searchpath, True,
+                                      watch_files=watcher)
+    assert loader.watcher is watcher
+    env = Environment(loader=loader)
+    assert env.get_template('child.html').render() == '<A>'
+    write('child.html', '{% extends "layout.html" %}'
+                        '{% block body %}B{% endblock %}')
+    os.utime(os.path.join(searchpath, 'child.html'), (1, 1))
+    wait_for('child.html', '<B>')
+    watcher.stop()
+test_watch_files = with_folders(test_watch_files)
+
+
+def test_invalidate_while_loading():
+    sources = []
+    def loader_func(name):
+        sources.append('v%d' % len(sources))
+        # the file changes while the first version is compiled
+        if len(sources) == 1:
+            loader.invalidate(name)
+        return sources[-1]
+    loader = loaders.FunctionLoader(loader_func, use_memcache=True)
+    env = Environment(loader=loader)
+    assert env.get_template('index.html').render() == 'v0'
+    assert env.get_template('index.html').render() == 'v1'
+    assert env.get_template('index.html').render() == 'v1'
+    assert sources == ['v0', 'v1']
+
+
+def test_precompile(searchpath, cache_folder):
+    from jinja.precompile import find_templates, precompile
+    def write(name, source):
+        write_file(os.path.join(searchpath, name), source)
+    os.mkdir(os.path.join(searchpath, 'sub'))
+    write('a.html', '{{ 1 + 1 }}')
+    write(os.path.join('sub', 'b.html'), '{% include "a.html" %}')
+    write('broken.html', '{% if %}')
+    write('.hidden', '')
+    loader = loaders.FileSystemLoader(searchpath,
+                                      cache_folder=cache_folder)
+    env = Environment(loader=loader)
+    assert find_templates(loader) == ['a.html', 'broken.html',
+                                      'sub/b.html']
+    for workers in 1, 2:
+        for filename in os.listdir(cache_folder):
+            os.remove(os.path.join(cache_folder, filename))
+        errors = precompile(env, workers=workers)
+        assert [name for name, error in errors] == ['broken.html']
+        for name in 'a.html', 'sub/b.html':
+            assert os.path.exists(loaders.get_cachename(cache_folder,
+                                                        name, searchpath))
+    env = Environment(loader=loader)
+    assert env.get_template('sub/b.html').render() == '2'
+test_precompile = with_folders(test_precompile)
+
+
+def test_bundle_loader(folder):
+    from jinja.precompile import build_bundle
+    filename = os.path.join(folder, 'templates.bundle')
+    loader = loaders.DictLoader({
+        'layout.html':  '[{% block body %}{% endblock %}]',
+        'child.html':   '{% extends "layout.html" %}'
+                        '{% block body %}{{ 1 + 1 }}{% endblock %}',
+        'broken.html':  '{% if %}'
+    })
+    errors = build_bundle(Environment(loader=loader), filename,
+                          ['child.html', 'broken.html'], workers=1)
+    assert [name for name, error in errors] == ['broken.html']
+
+    bundle_loader = loaders.BundleLoader(filename)
+    assert bundle_loader.bundle.names() == ['child.html']
+    assert [x[0] for x in bundle_loader.bundle.get_dependencies(
+            'child.html')] == ['layout.html']
+    env = Environment(loader=bundle_loader)
+    tmpl = env.get_template('child.html')
+    assert tmpl.render() == '[2]'
+    assert env.get_template('child.html') is tmpl
+    try:
+        env.get_template('layout.html')
+    except TemplateNotFound:
+        pass
+    else:
+        raise AssertionError('expected TemplateNotFound')
+
+    # templates missing in the bundle come from the fallback loader
+    env = Environment(loader=loaders.BundleLoader(filename, loader))
+    assert env.get_template('layout.html').render() == '[]'
+    assert env.from_string('{% extends "child.html" %}').render() == '[2]'
+    bundle_loader.bundle.close()
+
+    # bundles of other jinja versions are rejected when they are opened
+    import jinja
+    version = jinja.__version__
+    jinja.__version__ = '1.3dev-r1235'
+    try:
+        try:
+            loaders.BundleLoader(filename)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('opened a bundle of another version')
+    finally:
+        jinja.__version__ = version
+test_bundle_loader = with_folders(test_bundle_loader)
+
+
+def test_unrendered_templates(searchpath, cache_folder):
+    for name in 'a.html', 'b.html':
+        write_file(os.path.join(searchpath, name), '{{ "%s" }}' % name)
+    env = Environment(loader=loaders.FileSystemLoader(searchpath,
+                      True, cache_folder=cache_folder))
+    env.get_template('a.html')
+    env.get_template('b.html')
+    assert env.loader.unrendered_templates == 0
+
+    # a new loader loads the templates from the disk cache
+    env = Environment(loader=loaders.FileSystemLoader(searchpath,
+                      True, cache_folder=cache_folder))
+    a = env.get_template('a.html')
+    b = env.get_template('b.html')
+    assert a.generate_func is None
+    assert env.loader.unrendered_templates == 2
+    assert a.render() == 'a.html'
+    assert env.loader.unrendered_templates == 1
+test_unrendered_templates = with_folders(test_unrendered_templates)
+
+
+def test_compressed_cache(searchpath, cache_folder):
+    from jinja.compression import ZlibCodec, is_compressed
+    from jinja.translators.python import bytecode_header_size
+    write_file(os.path.join(searchpath, 'small.html'), '{{ 42 }}')
+    write_file(os.path.join(searchpath, 'big.html'), '{{ 42 }}' * 200)
+    loader = loaders.FileSystemLoader(searchpath,
+                                      cache_folder=cache_folder,
+                                      compress_cache=ZlibCodec(9),
+                                      compress_threshold=1000)
+    env = Environment(loader=loader)
+    assert env.get_template('small.html').render() == '42'
+    assert env.get_template('big.html').render() == '42' * 200
+    def cached(name):
+        f = file(loaders.get_cachename(cache_folder, name,
+                                       loader.searchpath), 'rb')
+        try:
+            return f.read()[bytecode_header_size:]
+        finally:
+            f.close()
+    assert not is_compressed(cached('small.html'))
+    assert is_compressed(cached('big.html'))
+
+    # loaded from the disk cache
+    env = Environment(loader=loaders.FileSystemLoader(searchpath,
+                      cache_folder=cache_folder))
+    assert env.get_template('big.html').render() == '42' * 200
+test_compressed_cache = with_folders(test_compressed_cache)
+
+
+def test_bytecode_header(searchpath, cache_folder):
+    from jinja.translators.python import Template
+    def get_env():
+        return Environment(loader=loaders.FileSystemLoader(searchpath,
+                           cache_folder=cache_folder))
+    write_file(os.path.join(searchpath, 'index.html'), '{{ 1 + 1 }}')
+    env = get_env()
+    tmpl = env.get_template('index.html')
+    data = tmpl.dump()
+    assert Template.load(env, data).source_hash == tmpl.source_hash
+    for broken in data[:-1], data[:8] + '9.9' + data[11:]:
+        try:
+            Template.load(env, broken)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('loaded broken bytecode')
+
+    # long version strings are not truncated
+    import jinja
+    version = jinja.__version__
+    try:
+        jinja.__version__ = '1.3dev-r1234'
+        data = tmpl.dump()
+        assert Template.load(env, data).source_hash == tmpl.source_hash
+        jinja.__version__ = '1.3dev-r1235'
+        try:
+            Template.load(env, data)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('loaded bytecode of another version')
+    finally:
+        jinja.__version__ = version
+
+    # broken cache files are ignored and overwritten
+    cache_fn = loaders.get_cachename(cache_folder, 'index.html',
+                                     env.loader.searchpath)
+    write_file(cache_fn, data[:-1])
+    env = get_env()
+    assert env.get_template('index.html').render() == '2'
+    assert env.loader.unrendered_templates == 0
+    env = get_env()
+    tmpl = env.get_template('index.html')
+    assert env.loader.unrendered_templates == 1
+
+    # a newer source with the same contents uses the cache file
+    os.utime(cache_fn, (1, 1))
+    env = get_env()
+    tmpl = env.get_template('index.html')
+    assert env.loader.unrendered_templates == 1
+test_bytecode_header = with_folders(test_bytecode_header)
+
+
+class MemcachedDictLoader(loaders.MemcachedLoaderMixin, loaders.DictLoader):
+
+    def __init__(self, templates, client, local_cache_size=0):
+        loaders.DictLoader.__init__(self, templates)
+        loaders.MemcachedLoaderMixin.__init__(self, True, client=client,
+            local_cache_size=local_cache_size)
+
+
+def test_memcached_local_cache():
+    templates = {'a': 'A', 'b': 'B', 'c': 'C', 'broken': '{% if %}'}
+    client = MemcacheClient()
+    env = Environment(loader=MemcachedDictLoader(templates, client, 40))
+    tmpl = env.get_template('a')
+    assert client.requests == 2
+    assert env.get_template('a') is tmpl
+    assert client.requests == 2
+    env.loader.clear_local_cache()
+    assert env.get_template('a').render() == 'A'
+    assert client.requests == 3
+
+    # without a local cache every load is a request
+    env = Environment(loader=MemcachedDictLoader(templates, client))
+    env.get_template('a')
+    env.get_template('a')
+    assert client.requests == 5
+
+    # preload fetches the templates with one request and stores the
+    # missing ones with another
+    client.requests = 0
+    env = Environment(loader=MemcachedDictLoader(templates, client, 40))
+    assert env.loader.preload(env, ['a', 'b', 'c']) == []
+    assert client.requests == 2
+    assert sorted(client.cache) == ['template/a', 'template/b', 'template/c']
+    assert [env.get_template(x).render() for x in 'abc'] == ['A', 'B', 'C']
+    assert client.requests == 2
+
+    # templates that fail to load are skipped
+    client.cache.clear()
+    env = Environment(loader=MemcachedDictLoader(templates, client, 40))
+    assert env.loader.preload(env, ['a', 'missing', 'broken', 'b']) == \
+           ['missing', 'broken']
+    assert sorted(client.cache) == ['template/a', 'template/b']
+
+
+def test_bytecode_cache(folder):
+    from jinja.bccache import MemoryBytecodeCache, FileSystemBytecodeCache
+    templates = {'index.html': '{{ 1 + 1 }}'}
+    times = {'index.html': 1}
+    def get_env(bytecode_cache):
+        return Environment(loader=loaders.FunctionLoader(templates.get,
+                           times.get, bytecode_cache=bytecode_cache))
+
+    cache = MemoryBytecodeCache()
+    env = get_env(cache)
+    assert env.get_template('index.html').render() == '2'
+    key = loaders.get_cache_key('index.html')
+    assert cache.load_bytecode(key)
+    env.loader.invalidate('index.html')
+    assert cache.load_bytecode(key) is None
+    assert env.get_template('index.html').render() == '2'
+
+    # other loaders use the bytecode as long as the source is the same
+    tmpl = env.from_string('cached')
+    tmpl.source_hash = env.loader.parse('index.html').source_hash
+    cache.dump_bytecode(key, tmpl.dump())
+    assert get_env(cache).get_template('index.html').render() == 'cached'
+    templates['index.html'] = 'changed'
+    assert get_env(cache).get_template('index.html').render() == 'changed'
+
+    # the file system cache
+    cache = FileSystemBytecodeCache(folder)
+    assert get_env(cache).get_template('index.html').render() == 'changed'
+    assert sorted(os.listdir(folder)) == ['.jinja_cache.lock',
+                                          'jinja_%s.cache' % key]
+    assert get_env(cache).get_template('index.html').render() == 'changed'
+    cache.clear()
+    assert os.listdir(folder) == ['.jinja_cache.lock']
+test_bytecode_cache = with_folders(test_bytecode_cache)
+
+
+def test_shared_memory_bytecode_cache(folder):
+    from jinja.bccache import SharedMemoryBytecodeCache
+    filename = os.path.join(folder, 'bytecode')
+    cache = SharedMemoryBytecodeCache(filename, 4096, 16)
+    assert cache.load_bytecode('foo') is None
+
+    # the child process dumps, the parent loads
+    pid = os.fork()
+    if not pid:
+        try:
+            cache.dump_bytecode('foo', 'bar')
+            cache.dump_bytecode('baz', 'x' * 100)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.load_bytecode('foo') == 'bar'
+    cache.dump_bytecode('foo', 'new')
+    assert cache.load_bytecode('foo') == 'new'
+
+    # another instance uses the same data
+    other = SharedMemoryBytecodeCache(filename, 4096, 16)
+    assert other.load_bytecode('baz') == 'x' * 100
+
+    # the cache is cleared if it's full
+    for x in xrange(40):
+        cache.dump_bytecode(str(x), 'x' * 500)
+    assert cache.load_bytecode('39') == 'x' * 500
+    assert cache.load_bytecode('foo') is None
+    other.clear()
+    assert cache.load_bytecode('39') is None
+
+    env = Environment(loader=loaders.FunctionLoader({'a.html':
+                      '{{ 42 }}'}.get, bytecode_cache=cache))
+    assert env.get_template('a.html').render() == '42'
+    assert other.load_bytecode(loaders.get_cache_key('a.html'))
+    cache.close()
+    other.close()
+test_shared_memory_bytecode_cache = \
+    with_folders(test_shared_memory_bytecode_cache)
+
+
+def test_shared_cache_folder(cache_folder):
+    log = os.path.join(cache_folder, 'log')
+    def loader_func(name):
+        fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, name + '\n')
+        finally:
+            os.close(fd)
+        time.sleep(0.2)
+        return '{{ 42 }}'
+    pids = []
+    for x in xrange(4):
+        pid = os.fork()
+        if not pid:
+            try:
+                env = Environment(loader=loaders.FunctionLoader(
+                    loader_func, cache_folder=cache_folder))
+                env.get_template('index.html').render()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    # only one process compiled the template, there are no temporary
+    # files left
+    f = file(log)
+    try:
+        assert f.read() == 'index.html\n'
+    finally:
+        f.close()
+    assert [x for x in os.listdir(cache_folder)
+            if x.startswith('jinja_')] == \
+           [os.path.basename(loaders.get_cachename(cache_folder,
+                                                   'index.html'))]
+test_shared_cache_folder = with_folders(test_shared_cache_folder)
+
+
+def test_prune_cache_folder(cache_folder):
+    from jinja.bccache import FileSystemBytecodeCache
+    def cache_files():
+        return sorted([x for x in os.listdir(cache_folder)
+                       if x.endswith('.cache')])
+    now = time.time()
+    for x in xrange(5):
+        write_file(os.path.join(cache_folder, 'jinja_%d.cache' % x),
+                   'x' * 100, now - 1000 * x)
+    write_file(os.path.join(cache_folder, 'jinja_0.cache.1.2.tmp'), '',
+               now - 7200)
+
+    def prune(**limits):
+        return FileSystemBytecodeCache(cache_folder, **limits).prune()
+    assert prune(max_age=3500) == 2
+    assert cache_files() == ['jinja_0.cache', 'jinja_1.cache',
+                             'jinja_2.cache', 'jinja_3.cache']
+    assert prune(max_size=300) == 1
+    assert prune(max_entries=1) == 2
+    assert cache_files() == ['jinja_0.cache']
+
+    # the loaders prune in the background
+    loader = loaders.FunctionLoader(lambda name: name,
+                                    cache_folder=cache_folder,
+                                    cache_max_entries=2)
+    loader.disk_cache.prune_interval = 0
+    env = Environment(loader=loader)
+    for name in 'a', 'b', 'c':
+        env.get_template(name)
+        time.sleep(0.1)
+    for x in xrange(100):
+        if len(cache_files()) <= 2:
+            break
+        time.sleep(0.01)
+    assert len(cache_files()) == 2
+    assert loader.prune() == 0
+test_prune_cache_folder = with_folders(test_prune_cache_folder)
+
+
+class CountingDictLoader(loaders.DictLoader):
+    """A dict loader that counts the lookups."""
+
+    def __init__(self, templates):
+        loaders.DictLoader.__init__(self, templates)
+        self.lookups = 0
+
+    def get_source(self, environment, name, parent):
+        self.lookups += 1
+        return loaders.DictLoader.get_source(self, environment, name, parent)
+
+
+def test_choice_loader_resolution_cache():
+    first = CountingDictLoader({'a': 'A'})
+    second = CountingDictLoader({'b': 'B'})
+    loader = loaders.ChoiceLoader([first, second], resolution_ttl=60)
+    env = Environment(loader=loader)
+    for x in xrange(3):
+        assert env.get_template('b').render() == 'B'
+        try:
+            env.get_template('missing')
+        except TemplateNotFound:
+            pass
+        else:
+            raise AssertionError('expected TemplateNotFound')
+    assert (first.lookups, second.lookups) == (2, 4)
+
+    # removed templates are looked up again
+    second.templates['a'] = second.templates.pop('b')
+    try:
+        env.get_template('b')
+    except TemplateNotFound:
+        pass
+    else:
+        raise AssertionError('expected TemplateNotFound')
+    assert (first.lookups, second.lookups) == (3, 6)
+
+    # expired results too
+    loader.resolution_ttl = 0.01
+    loader.clear_resolution_cache()
+    for x in xrange(2):
+        try:
+            env.get_template('missing.html')
+        except TemplateNotFound:
+            pass
+        else:
+            raise AssertionError('expected TemplateNotFound')
+        first.templates['missing.html'] = 'found'
+    time.sleep(0.02)
+    assert env.get_template('missing.html').render() == 'found'
+
+
+def test_choice_loader_watch_files(first, second):
+    from jinja.watcher import PollingWatcher
+    watcher = PollingWatcher(0.01)
+    try:
+        write_file(os.path.join(second, 'index.html'), 'second')
+        env = Environment(loader=loaders.ChoiceLoader([
+            loaders.FileSystemLoader(first),
+            loaders.FileSystemLoader(second)
+        ], watch_files=watcher))
+        assert env.get_template('index.html').render() == 'second'
+        write_file(os.path.join(first, 'index.html'), 'first')
+        for x in xrange(100):
+            if env.get_template('index.html').render() == 'first':
+                break
+            time.sleep(0.05)
+        else:
+            raise AssertionError('template not resolved again')
+
+        # only the templates in the resolution cache are watched
+        class SmallChoiceLoader(loaders.ChoiceLoader):
+            resolution_cache_size = 5
+        watcher.stop()
+        watcher = PollingWatcher(0.01)
+        loader = SmallChoiceLoader([loaders.FileSystemLoader(first),
+                                    loaders.FileSystemLoader(second)],
+                                   watch_files=watcher)
+        env = Environment(loader=loader)
+        for x in xrange(20):
+            try:
+                env.get_template('missing%d.html' % x)
+            except TemplateNotFound:
+                pass
+        assert sorted(loader._watched) == ['missing%d.html' % x
+                                           for x in xrange(15, 20)]
+        assert len(watcher._callbacks) == len(watcher._times) == 10
+        loader.clear_resolution_cache()
+        assert loader._watched == {}
+        assert watcher._callbacks == watcher._times == {}
+    finally:
+        watcher.stop()
+test_choice_loader_watch_files = with_folders(test_choice_loader_watch_files)
+
+
+def test_choice_loader_missing_folder(folder):
+    from jinja.watcher import get_watcher, InotifyWatcher
+    searchpath = os.path.join(folder, 'templates')
+    watcher = get_watcher(0.01)
+    try:
+        if isinstance(watcher, InotifyWatcher):
+            assert not watcher.watch(os.path.join(searchpath, 'index.html'),
+                                     lambda: None)
+        env = Environment(loader=loaders.ChoiceLoader([
+            loaders.FileSystemLoader(searchpath)
+        ], watch_files=watcher))
+        try:
+            env.get_template('index.html')
+        except TemplateNotFound:
+            pass
+        else:
+            raise AssertionError('expected TemplateNotFound')
+
+        # the folder couldn't be watched, so the template is found once
+        # it's created
+        os.mkdir(searchpath)
+        write_file(os.path.join(searchpath, 'index.html'), 'created')
+        for x in xrange(100):
+            try:
+                assert env.get_template('index.html').render() == 'created'
+            except TemplateNotFound:
+                time.sleep(0.05)
+            else:
+                break
+        else:
+            raise AssertionError('template not resolved again')
+    finally:
+        watcher.stop()
+test_choice_loader_missing_folder = \
+    with_folders(test_choice_loader_missing_folder)
+
+
+def test_filesystem_loader_index(searchpath):
+    def write(name, source):
+        write_file(os.path.join(searchpath, name), source)
+    assert filesystem_loader.list_templates() == [
+        'brokenimport.html', 'foo/test.html', 'test.html']
+    write('a.html', 'A')
+    write('.hidden', 'H')
+    loader = loaders.FileSystemLoader(searchpath, use_index=True)
+    env = Environment(loader=loader)
+    assert loader.list_templates() == ['a.html']
+    assert env.get_template('a.html').render() == 'A'
+
+    # new templates are unknown until the index is refreshed
+    write('b.html', 'B')
+    try:
+        env.get_template('b.html')
+    except TemplateNotFound:
+        pass
+    else:
+        raise AssertionError('expected template exception')
+    loader.refresh_index('b.html')
+    assert loader.list_templates() == ['a.html', 'b.html']
+    assert env.get_template('b.html').render() == 'B'
+
+    # removed templates are not found even before the refresh
+    os.remove(os.path.join(searchpath, 'a.html'))
+    try:
+        env.get_template('a.html')
+    except TemplateNotFound:
+        pass
+    else:
+        raise AssertionError('expected template exception')
+    loader.refresh_index()
+    assert loader.list_templates() == ['b.html']
+    assert loader.check_source_changed(env, 'a.html') == -1
+test_filesystem_loader_index = with_folders(test_filesystem_loader_index)
+
+
+def test_filesystem_loader_index_links(searchpath, folder):
+    if not hasattr(os, 'symlink'):
+        return
+    write_file(os.path.join(folder, 'a.html'), 'A')
+    os.symlink(folder, os.path.join(searchpath, 'linked'))
+    os.symlink(folder, os.path.join(folder, 'loop'))
+    os.symlink(searchpath, os.path.join(searchpath, 'self'))
+    for use_index in False, True:
+        loader = loaders.FileSystemLoader(searchpath, use_index=use_index)
+        assert loader.list_templates() == ['linked/a.html']
+        env = Environment(loader=loader)
+        assert env.get_template('linked/a.html').render() == 'A'
+test_filesystem_loader_index_links = \
+    with_folders(test_filesystem_loader_index_links)
+
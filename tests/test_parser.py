@@ -7,7 +7,7 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from jinja import Environment
+from jinja import Environment, DictLoader
 
 NO_VARIABLE_BLOCK = '''\
 {# i'm a freaking comment #}\
@@ -91,3 +91,16 @@ def test_balancing(env):
 def test_start_comment(env):
     tmpl = env.from_string(STARTCOMMENT)
     assert tmpl.render().strip() == 'foo'
+
+
+def test_tree_cache():
+    env = Environment(loader=DictLoader({
+        'layout':   '<{% block a %}A{% block b %}B{% endblock %}{% endblock %}>',
+        'child1':   '{% extends "layout" %}{% block b %}1{% endblock %}',
+        'child2':   '{% extends "layout" %}{% block a %}2{% endblock %}'
+    }))
+    for x in xrange(2):
+        assert env.get_template('child1').render() == '<A1>'
+        assert env.get_template('child2').render() == '<2>'
+        assert env.get_template('layout').render() == '<AB>'
+    assert env.parse('{{ foo }}') is not env.parse('{{ foo }}')
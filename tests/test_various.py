@@ -6,6 +6,7 @@
     :copyright: 2007 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
+from jinja import Environment, DictLoader
 from jinja.exceptions import TemplateSyntaxError
 
 KEYWORDS = '''\
@@ -111,3 +112,28 @@ def test_localset(env):
 def test_nonlocalset(env):
     tmpl = env.from_string(NONLOCALSET)
     assert tmpl.render() == '1'
+
+
+def test_from_string_cache():
+    env = Environment(from_string_cache_size=2, loader=DictLoader({
+        'layout':   '[{% block a %}{% endblock %}]'
+    }))
+    tmpl = env.from_string('{{ foo }}')
+    assert env.from_string('{{ foo }}') is tmpl
+    assert env.from_string_cache_hits == env.from_string_cache_misses == 1
+    child = '{% extends "layout" %}{% block a %}42{% endblock %}'
+    assert env.from_string(child) is not env.from_string(child)
+    assert env.from_string(child).render() == '[42]'
+    for source in 'a', 'b', '{{ foo }}':
+        env.from_string(source)
+    assert env.from_string_cache_misses == 7
+    env = Environment(from_string_cache_size=0)
+    assert env.from_string('{{ foo }}') is not env.from_string('{{ foo }}')
+
+    # changed settings are not served the templates of the old ones
+    env = Environment(inline_filters=True)
+    env.filters['x'] = lambda: lambda env, context, value: 'old'
+    assert env.from_string('{{ 1|x }}').render() == 'old'
+    env.inline_filters = False
+    env.filters['x'] = lambda: lambda env, context, value: 'new'
+    assert env.from_string('{{ 1|x }}').render() == 'new'